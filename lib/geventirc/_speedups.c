@@ -0,0 +1,345 @@
+/*
+ * Optional C implementations of geventirc.message.irc_split and ctcp_split.
+ *
+ * These must behave exactly like the pure-Python versions in message.py,
+ * which are used whenever this module isn't available. Both are checked
+ * against the same corpus in tests/test_conformance.py.
+ *
+ * On a line with no command, raises the ProtocolViolationError set on this
+ * module by message.py (or ValueError if it hasn't been set).
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <string.h>
+
+#define X_DELIM '\x01'
+#define X_QUOTE '\x86'
+#define M_QUOTE '\x10'
+
+typedef struct {
+    const char *prefix;
+    Py_ssize_t prefix_len;
+    const char *command;
+    Py_ssize_t command_len;
+    /* everything after the command */
+    const char *params;
+    Py_ssize_t params_len;
+    /* offset into params of the ':' that starts the trailing param, or -1 */
+    Py_ssize_t trailing;
+} split_t;
+
+static void
+raise_no_command(PyObject *module, const char *buf, Py_ssize_t len)
+{
+    PyObject *exc, *rest;
+
+    exc = PyObject_GetAttrString(module, "ProtocolViolationError");
+    if (exc == NULL) {
+        PyErr_Clear();
+        exc = PyExc_ValueError;
+        Py_INCREF(exc);
+    }
+    rest = PyBytes_FromStringAndSize(buf, len);
+    if (rest != NULL) {
+        PyErr_Format(exc, "no command received: %R", rest);
+        Py_DECREF(rest);
+    }
+    Py_DECREF(exc);
+}
+
+static int
+do_split(PyObject *module, const char *data, Py_ssize_t len, split_t *s)
+{
+    const char *buf = data, *end = data + len, *sp, *p;
+
+    s->prefix = data;
+    s->prefix_len = 0;
+    if (len > 0 && buf[0] == ':') {
+        sp = memchr(buf + 1, ' ', len - 1);
+        if (sp != NULL) {
+            s->prefix = buf + 1;
+            s->prefix_len = sp - (buf + 1);
+            buf = sp + 1;
+        }
+    }
+
+    sp = memchr(buf, ' ', end - buf);
+    if (sp == NULL) {
+        raise_no_command(module, buf, end - buf);
+        return -1;
+    }
+    s->command = buf;
+    s->command_len = sp - buf;
+
+    buf = sp + 1;
+    s->params = buf;
+    s->params_len = end - buf;
+    s->trailing = -1;
+    if (s->params_len > 0 && buf[0] == ':') {
+        s->trailing = 0;
+    }
+    else {
+        p = buf;
+        while ((p = memchr(p, ' ', end - p)) != NULL) {
+            if (p + 1 < end && p[1] == ':') {
+                s->trailing = p + 1 - buf;
+                break;
+            }
+            p++;
+        }
+    }
+    return 0;
+}
+
+/* Append len bytes from start to list as a new bytes object */
+static int
+append_bytes(PyObject *list, const char *start, Py_ssize_t len)
+{
+    int result;
+    PyObject *item = PyBytes_FromStringAndSize(start, len);
+
+    if (item == NULL)
+        return -1;
+    result = PyList_Append(list, item);
+    Py_DECREF(item);
+    return result;
+}
+
+static PyObject *
+split_params(split_t *s)
+{
+    PyObject *params;
+    const char *buf = s->params, *start, *end, *sp;
+
+    params = PyList_New(0);
+    if (params == NULL)
+        return NULL;
+
+    if (s->trailing == 0) {
+        if (append_bytes(params, buf + 1, s->params_len - 1) < 0)
+            goto error;
+        return params;
+    }
+
+    /* like bytes.split(b' '), so empty params are kept */
+    start = buf;
+    end = buf + (s->trailing > 0 ? s->trailing - 1 : s->params_len);
+    while ((sp = memchr(start, ' ', end - start)) != NULL) {
+        if (append_bytes(params, start, sp - start) < 0)
+            goto error;
+        start = sp + 1;
+    }
+    if (append_bytes(params, start, end - start) < 0)
+        goto error;
+    if (s->trailing > 0) {
+        if (append_bytes(params, buf + s->trailing + 1, s->params_len - s->trailing - 1) < 0)
+            goto error;
+    }
+    return params;
+
+error:
+    Py_DECREF(params);
+    return NULL;
+}
+
+/* Get a read-only view of bytes-like or str (as utf-8) arg */
+static int
+get_data(PyObject *arg, Py_buffer *view, const char **data, Py_ssize_t *len)
+{
+    PyObject *copy;
+    int rc;
+
+    view->obj = NULL;
+    if (PyUnicode_Check(arg)) {
+        *data = PyUnicode_AsUTF8AndSize(arg, len);
+        return *data == NULL ? -1 : 0;
+    }
+    if (PyObject_GetBuffer(arg, view, PyBUF_SIMPLE) < 0) {
+        /* not contiguous, eg. a strided memoryview: take a contiguous copy, as the Python version does */
+        if (!PyErr_ExceptionMatches(PyExc_BufferError))
+            return -1;
+        PyErr_Clear();
+        view->obj = NULL;
+        copy = PyBytes_FromObject(arg);
+        if (copy == NULL)
+            return -1;
+        /* the view keeps its own reference to the copy until it is released */
+        rc = PyObject_GetBuffer(copy, view, PyBUF_SIMPLE);
+        Py_DECREF(copy);
+        if (rc < 0)
+            return -1;
+    }
+    *data = view->buf;
+    *len = view->len;
+    return 0;
+}
+
+static PyObject *
+irc_split(PyObject *module, PyObject *arg)
+{
+    Py_buffer view;
+    const char *data;
+    Py_ssize_t len;
+    split_t s;
+    PyObject *params, *result = NULL;
+
+    if (get_data(arg, &view, &data, &len) < 0)
+        return NULL;
+    if (do_split(module, data, len, &s) < 0)
+        goto done;
+    params = split_params(&s);
+    if (params == NULL)
+        goto done;
+    result = Py_BuildValue("(y#y#N)", s.prefix, s.prefix_len, s.command, s.command_len, params);
+
+done:
+    if (view.obj != NULL)
+        PyBuffer_Release(&view);
+    return result;
+}
+
+/* Undo quoting in place, returning the new length.
+ * quote followed by a char in from[] becomes the matching char in to[],
+ * followed by anything else it is dropped, and a final lone quote is kept. */
+static Py_ssize_t
+dequote(char *buf, Py_ssize_t len, char quote, const char *from, const char *to)
+{
+    Py_ssize_t in = 0, out = 0;
+    const char *match;
+
+    while (in < len) {
+        if (buf[in] == quote && in + 1 < len) {
+            match = memchr(from, buf[in + 1], strlen(from));
+            buf[out++] = match != NULL ? to[match - from] : buf[in + 1];
+            in += 2;
+        }
+        else {
+            buf[out++] = buf[in++];
+        }
+    }
+    return out;
+}
+
+static const char low_level_from[] = {'0', 'n', 'r', M_QUOTE, '\0'};
+static const char low_level_to[] = {'\0', '\n', '\r', M_QUOTE};
+static const char ctcp_from[] = {'a', X_QUOTE, '\0'};
+static const char ctcp_to[] = {X_DELIM, X_QUOTE};
+
+static int
+add_ctcp_segment(PyObject *normal, PyObject *extended, char *seg, Py_ssize_t len, int odd)
+{
+    char *sp, *start, *end;
+    PyObject *item;
+    int result;
+
+    if (len == 0)
+        return 0;
+    if (odd) {
+        len = dequote(seg, len, X_QUOTE, ctcp_from, ctcp_to);
+        sp = memchr(seg, ' ', len);
+        if (sp == NULL)
+            item = Py_BuildValue("(y#O)", seg, len, Py_None);
+        else
+            item = Py_BuildValue("(y#y#)", seg, (Py_ssize_t)(sp - seg), sp + 1, len - (sp - seg) - 1);
+        if (item == NULL)
+            return -1;
+        result = PyList_Append(extended, item);
+        Py_DECREF(item);
+        return result;
+    }
+    start = seg;
+    end = seg + len;
+    while (start < end) {
+        sp = memchr(start, ' ', end - start);
+        if (sp == NULL)
+            sp = end;
+        if (sp > start && append_bytes(normal, start, sp - start) < 0)
+            return -1;
+        start = sp + 1;
+    }
+    return 0;
+}
+
+static PyObject *
+ctcp_split(PyObject *module, PyObject *arg)
+{
+    Py_buffer view;
+    const char *data;
+    Py_ssize_t len, joined_len, index;
+    split_t s;
+    char *buf = NULL, *seg, *delim, *end;
+    int odd = 0;
+    PyObject *normal = NULL, *extended = NULL, *result = NULL;
+
+    if (get_data(arg, &view, &data, &len) < 0)
+        return NULL;
+    if (do_split(module, data, len, &s) < 0)
+        goto done;
+
+    /* params rejoined with spaces: the ':' introducing the trailing param is dropped */
+    buf = PyMem_Malloc(s.params_len + 1);
+    if (buf == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    if (s.trailing < 0) {
+        memcpy(buf, s.params, s.params_len);
+        joined_len = s.params_len;
+    }
+    else {
+        index = s.trailing;
+        memcpy(buf, s.params, index);
+        memcpy(buf + index, s.params + index + 1, s.params_len - index - 1);
+        joined_len = s.params_len - 1;
+    }
+    joined_len = dequote(buf, joined_len, M_QUOTE, low_level_from, low_level_to);
+
+    normal = PyList_New(0);
+    extended = PyList_New(0);
+    if (normal == NULL || extended == NULL)
+        goto done;
+    seg = buf;
+    end = buf + joined_len;
+    while ((delim = memchr(seg, X_DELIM, end - seg)) != NULL) {
+        if (add_ctcp_segment(normal, extended, seg, delim - seg, odd) < 0)
+            goto done;
+        odd = !odd;
+        seg = delim + 1;
+    }
+    if (add_ctcp_segment(normal, extended, seg, end - seg, odd) < 0)
+        goto done;
+
+    result = Py_BuildValue("(y#y#OO)", s.prefix, s.prefix_len, s.command, s.command_len,
+                           normal, extended);
+
+done:
+    Py_XDECREF(normal);
+    Py_XDECREF(extended);
+    PyMem_Free(buf);
+    if (view.obj != NULL)
+        PyBuffer_Release(&view);
+    return result;
+}
+
+static PyMethodDef speedups_methods[] = {
+    {"irc_split", irc_split, METH_O,
+     "Split a line into (prefix, command, params). See message.irc_split."},
+    {"ctcp_split", ctcp_split, METH_O,
+     "Split and dequote a line into (prefix, command, params, ctcp_params). See message.ctcp_split."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef speedups_module = {
+    PyModuleDef_HEAD_INIT,
+    "geventirc._speedups",
+    "C implementations of hot paths in geventirc.message",
+    -1,
+    speedups_methods
+};
+
+PyMODINIT_FUNC
+PyInit__speedups(void)
+{
+    return PyModule_Create(&speedups_module);
+}
@@ -0,0 +1,406 @@
+"""Append-only, segmented storage for channel traffic.
+
+Records are stored one per line as "<timestamp> <channel> <raw line>\\n" in
+numbered segment files inside a directory. Each segment has an index mapping
+(channel, time bucket) to the byte range holding that channel's records for
+that bucket, so a time range can be read back through mmap without scanning
+whole files. Segments are sealed once they reach segment_size bytes, at which
+point the index is written beside them and they are optionally gzipped.
+"""
+
+from __future__ import absolute_import
+
+import gzip
+import json
+import logging
+import mmap
+import os
+import time
+
+import gevent
+import gevent.event
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_PREFIXES = '#&+!'
+NO_CHANNEL = '*'
+
+SEGMENT_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+COMPRESSED_SUFFIX = '.log.gz'
+
+
+def _to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+def _to_text(s):
+    if isinstance(s, bytes):
+        return s.decode('utf-8', 'replace')
+    return s
+
+def message_channel(msg):
+    """Return the channel a message belongs to, or NO_CHANNEL"""
+    if msg.params and msg.params[0][:1] in CHANNEL_PREFIXES:
+        return msg.params[0]
+    return NO_CHANNEL
+
+
+class Segment(object):
+    """One segment file plus its (channel, bucket) index.
+    index is a dict {channel: {bucket: [start, end]}}, with offsets into the uncompressed data.
+    """
+
+    def __init__(self, path, seq, bucket_size):
+        self.path = path
+        self.seq = seq
+        self.bucket_size = bucket_size
+        self.index = {}
+        self.start_time = None
+        self.end_time = None
+        self.size = 0
+        self.compressed = False
+
+    @property
+    def base(self):
+        return os.path.join(self.path, '%08d' % self.seq)
+
+    @property
+    def filename(self):
+        return self.base + (COMPRESSED_SUFFIX if self.compressed else SEGMENT_SUFFIX)
+
+    def add(self, timestamp, channel, offset, length):
+        bucket = int(timestamp // self.bucket_size)
+        ranges = self.index.setdefault(channel, {})
+        if bucket in ranges:
+            ranges[bucket][1] = offset + length
+        else:
+            ranges[bucket] = [offset, offset + length]
+        if self.start_time is None or timestamp < self.start_time:
+            self.start_time = timestamp
+        if self.end_time is None or timestamp > self.end_time:
+            self.end_time = timestamp
+        self.size = offset + length
+
+    def overlaps(self, start, end):
+        if self.start_time is None:
+            return False
+        if start is not None and self.end_time < start:
+            return False
+        if end is not None and self.start_time > end:
+            return False
+        return True
+
+    def ranges(self, channel=None, start=None, end=None):
+        """Return (start, end) byte ranges, in file order, that may contain matching records"""
+        first = None if start is None else int(start // self.bucket_size)
+        last = None if end is None else int(end // self.bucket_size)
+        # copy, as the writer thread may be adding to the index of the active segment
+        channels = list(self.index.keys()) if channel is None else [channel]
+        ranges = []
+        for name in channels:
+            for bucket, byte_range in list(self.index.get(name, {}).items()):
+                if first is not None and bucket < first:
+                    continue
+                if last is not None and bucket > last:
+                    continue
+                ranges.append(tuple(byte_range))
+        # merge overlapping ranges so no record is yielded twice
+        merged = []
+        for r_start, r_end in sorted(ranges):
+            if merged and r_start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], r_end))
+            else:
+                merged.append((r_start, r_end))
+        return merged
+
+    def save_index(self):
+        data = {
+            'bucket_size': self.bucket_size,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'size': self.size,
+            'index': {channel: {str(bucket): r for bucket, r in buckets.items()}
+                      for channel, buckets in self.index.items()},
+        }
+        tmp = self.base + INDEX_SUFFIX + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, self.base + INDEX_SUFFIX)
+
+    def load_index(self):
+        with open(self.base + INDEX_SUFFIX) as f:
+            data = json.load(f)
+        self.bucket_size = data['bucket_size']
+        self.start_time = data['start_time']
+        self.end_time = data['end_time']
+        self.size = data['size']
+        self.index = {channel: {int(bucket): r for bucket, r in buckets.items()}
+                      for channel, buckets in data['index'].items()}
+
+    def rebuild_index(self):
+        """Scan the segment to recreate the index, eg. for an unsealed segment after a crash"""
+        self.index = {}
+        self.start_time = self.end_time = None
+        self.size = 0
+        offset = 0
+        for record in self._iter_file():
+            length = len(record)
+            if not record.endswith(b'\n'):
+                break # partial final write
+            timestamp, channel, line = parse_record(record)
+            self.add(timestamp, _to_text(channel), offset, length)
+            offset += length
+
+    def truncate(self):
+        """Discard anything after the last complete record, eg. a partial final write"""
+        if os.path.getsize(self.filename) > self.size:
+            logger.warning("Truncating partial record at end of %r", self.filename)
+            with open(self.filename, 'r+b') as f:
+                f.truncate(self.size)
+
+    def _iter_file(self):
+        opener = gzip.open if self.compressed else open
+        with opener(self.filename, 'rb') as f:
+            for record in f:
+                yield record
+
+    def read(self, channel=None, start=None, end=None):
+        """Yield (timestamp, channel, line) for records matching the given filters"""
+        if not self.overlaps(start, end):
+            return
+        ranges = self.ranges(channel, start, end)
+        if not ranges:
+            return
+        if self.compressed:
+            with gzip.open(self.filename, 'rb') as f:
+                data = f.read()
+            for record in self._read_ranges(data, ranges, channel, start, end):
+                yield record
+            return
+        with open(self.filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for record in self._read_ranges(data, ranges, channel, start, end):
+                    yield record
+            finally:
+                data.close()
+
+    def _read_ranges(self, data, ranges, channel, start, end):
+        want_channel = None if channel is None else _to_bytes(channel)
+        for r_start, r_end in ranges:
+            pos = r_start
+            while pos < r_end:
+                eol = data.find(b'\n', pos, r_end)
+                if eol == -1:
+                    break
+                timestamp, rec_channel, line = parse_record(data[pos:eol])
+                pos = eol + 1
+                if want_channel is not None and rec_channel != want_channel:
+                    continue
+                if start is not None and timestamp < start:
+                    continue
+                if end is not None and timestamp > end:
+                    continue
+                yield timestamp, _to_text(rec_channel), line
+
+
+def format_record(timestamp, channel, line):
+    return b' '.join([('%.6f' % timestamp).encode('ascii'), _to_bytes(channel), _to_bytes(line)]) + b'\n'
+
+def parse_record(record):
+    timestamp, channel, line = record.rstrip(b'\n').split(b' ', 2)
+    return float(timestamp), channel, line
+
+
+class SegmentLog(object):
+    """An append-only log of raw lines, split into segments in directory path.
+
+    Appends are buffered in memory and written in batches by a background greenlet,
+    once flush_size bytes are pending or every flush_interval seconds, whichever comes first.
+    The file writes themselves happen in the hub's threadpool so disk latency doesn't stall
+    the event loop.
+
+    segment_size: size in bytes after which the active segment is sealed and a new one started
+    bucket_size: width in seconds of the index time buckets
+    compress: if True, sealed segments are gzipped
+    readonly: if True, only open an existing log for searching. Nothing on disk is changed,
+        so this is safe while another SegmentLog is writing to the same directory.
+    """
+
+    def __init__(self, path, segment_size=64*1024*1024, bucket_size=3600,
+                 flush_size=64*1024, flush_interval=1.0, compress=False, readonly=False):
+        self.path = path
+        self.segment_size = segment_size
+        self.bucket_size = bucket_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.compress = compress
+        self.readonly = readonly
+
+        self._pending = []
+        self._pending_size = 0
+        self._wakeup = gevent.event.Event()
+        self._flushed = gevent.event.Event()
+        self._writer = None
+        self._writing = False
+        self._seal_requested = False
+        self._file = None
+        self.closed = False
+
+        if not readonly and not os.path.isdir(path):
+            os.makedirs(path)
+        self.segments = self._load_segments()
+        if self.segments and not self.segments[-1].compressed \
+                and not os.path.exists(self.segments[-1].base + INDEX_SUFFIX):
+            self.active = self.segments.pop()
+            if not readonly:
+                # we're going to append to it, so new records mustn't follow any garbage from a crash
+                self.active.truncate()
+        else:
+            seq = self.segments[-1].seq + 1 if self.segments else 0
+            self.active = Segment(path, seq, bucket_size)
+
+    def _load_segments(self):
+        seqs = {}
+        for name in os.listdir(self.path):
+            for suffix in (COMPRESSED_SUFFIX, SEGMENT_SUFFIX):
+                if name.endswith(suffix):
+                    seqs[int(name[:-len(suffix)])] = suffix == COMPRESSED_SUFFIX
+                    break
+        segments = []
+        for seq in sorted(seqs):
+            segment = Segment(self.path, seq, self.bucket_size)
+            segment.compressed = seqs[seq]
+            if os.path.exists(segment.base + INDEX_SUFFIX):
+                segment.load_index()
+            else:
+                segment.rebuild_index()
+            segments.append(segment)
+        return segments
+
+    def append(self, line, channel=NO_CHANNEL, timestamp=None):
+        """Queue a raw line for writing. Does not block."""
+        if self.closed:
+            raise ValueError("append() on closed SegmentLog")
+        if self.readonly:
+            raise ValueError("append() on read-only SegmentLog")
+        if timestamp is None:
+            timestamp = time.time()
+        self._pending.append((timestamp, channel or NO_CHANNEL, line))
+        self._pending_size += len(line)
+        if self._writer is None:
+            self._writer = gevent.spawn(self._write_loop)
+        if self._pending_size >= self.flush_size:
+            self._wakeup.set()
+
+    def flush(self):
+        """Block until everything appended so far has been written"""
+        while self._writer is not None and (self._pending or self._writing or self._seal_requested):
+            self._flushed.clear()
+            self._wakeup.set()
+            self._flushed.wait()
+
+    def _write_loop(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            batch, self._pending, self._pending_size = self._pending, [], 0
+            seal, self._seal_requested = self._seal_requested, False
+            if batch or seal:
+                self._writing = True
+                try:
+                    gevent.get_hub().threadpool.apply(self._write, (batch, seal))
+                except Exception:
+                    logger.exception("Failed to write %d records to %r", len(batch), self.path)
+                finally:
+                    self._writing = False
+            self._flushed.set()
+            if self.closed and not self._pending:
+                return
+
+    def _write(self, batch, seal=False):
+        """Runs in a thread. Appends batch to the active segment, rotating as needed,
+        then seals the active segment if seal is True.
+        """
+        for timestamp, channel, line in batch:
+            if self._file is None:
+                self._file = open(self.active.filename, 'ab')
+            record = format_record(timestamp, channel, line)
+            self._file.write(record)
+            self.active.add(timestamp, _to_text(channel), self.active.size, len(record))
+            if self.active.size >= self.segment_size:
+                self._seal()
+        if self._file is not None:
+            self._file.flush()
+        if seal:
+            self._seal()
+
+    def _seal(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        segment = self.active
+        if segment.size:
+            if self.compress:
+                with open(segment.filename, 'rb') as src:
+                    with gzip.open(segment.base + COMPRESSED_SUFFIX, 'wb') as dest:
+                        for chunk in iter(lambda: src.read(1024*1024), b''):
+                            dest.write(chunk)
+                os.remove(segment.filename)
+                segment.compressed = True
+            segment.save_index()
+            self.segments.append(segment)
+            self.active = Segment(self.path, segment.seq + 1, self.bucket_size)
+
+    def rotate(self):
+        """Seal the active segment now, regardless of its size"""
+        if self.closed:
+            raise ValueError("rotate() on closed SegmentLog")
+        if self.readonly:
+            raise ValueError("rotate() on read-only SegmentLog")
+        # sealing is left to the writer, so it can't happen in the middle of a write
+        self._seal_requested = True
+        if self._writer is None:
+            self._writer = gevent.spawn(self._write_loop)
+        self.flush()
+
+    def close(self):
+        """Flush pending records and close the active segment. The active segment is left unsealed."""
+        if self.closed:
+            return
+        self.closed = True
+        if self._writer is not None:
+            self._wakeup.set()
+            self._writer.join()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def search(self, start=None, end=None, channel=None):
+        """Yield (timestamp, channel, line) for stored records in the given time range (inclusive)
+        and optionally only for the given channel, in order of storage.
+        Records still pending a flush are not included.
+        """
+        for segment in self.segments + [self.active]:
+            for record in segment.read(channel, start, end):
+                yield record
+
+
+class LogHandler(object):
+    """Handler which records every message the client receives to a SegmentLog.
+    Uses the raw line and receive time recorded by the client where available.
+    Any kwargs are passed through to SegmentLog.
+    """
+
+    def __init__(self, path, **kwargs):
+        self.log = SegmentLog(path, **kwargs)
+
+    def __call__(self, client, msg):
+        line = getattr(msg, 'line', None)
+        if line is None:
+            line = msg.encode()[:-2]
+        self.log.append(line, message_channel(msg), getattr(msg, 'received_at', None))
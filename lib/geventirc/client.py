@@ -2,17 +2,26 @@ from __future__ import absolute_import
 
 import logging
 import errno
+import itertools
+import time
 from collections import defaultdict
 
+import gevent.event
 import gevent.queue
 import gevent.pool
 from gevent import socket
 
-from geventirc import message
+from geventirc import connection, message
+from geventirc.scheduler import Scheduler, TaskGroup
 
 IRC_PORT = 194
 IRCS_PORT = 994
 
+# keepalive PINGs carry this prefix followed by a counter, so we can match up their PONGs
+PING_TOKEN_PREFIX = 'geventirc-'
+# weight given to each new lag measurement in smoothed_lag, as for TCP's smoothed RTT
+LAG_SMOOTHING = 0.125
+
 logger = logging.getLogger(__name__)
 
 
@@ -20,10 +29,25 @@ class Client(object):
     _socket = None
     started = False
     stopped = False
+    _stopping = False
+    last_lag = None
+    smoothed_lag = None
+    _ping_message = None
+    _ping_queued = None
+    _ping_sent = None
+    _scheduler = None
+    _tasks = None
+    _draining = False
+    _deferred_quit = None
+    _send_greenlet = None
+    _recv_greenlet = None
+    _keepalive_greenlet = None
 
     def __init__(self, hostname, nick, port=IRC_PORT,
                  local_hostname=None, server_name=None, real_name=None,
-                 disconnect_handler=[], twitch=False, password=None):
+                 disconnect_handler=[], twitch=False, password=None,
+                 keepalive=None, max_lag=None, congestion_lag=None, scheduler=None,
+                 connect_timeout=None, dns_timeout=None, dns_cache=None):
         """Create a new IRC connection to given host and port.
         local_hostname, server_name and real_name are optional args
             that control how we report ourselves to the server
@@ -33,6 +57,19 @@ class Client(object):
             You may alternatively pass in a list of multiple callbacks.
             Note that after instantiation you can add/remove further disconnect callbacks
             by manipulating the client.disconnect_handlers set.
+        keepalive, if given, is a number of seconds. After that long without receiving anything,
+            we send a PING to measure lag and check the connection is still alive.
+            See lag and smoothed_lag.
+        max_lag is how long to wait for the PONG before giving up on the connection and stopping.
+            Defaults to keepalive. Use a disconnect handler to reconnect.
+        congestion_lag, if given, is a smoothed lag in seconds above which we consider the server
+            congested, and delay each message we send by the smoothed lag.
+        scheduler is a Scheduler to share with other clients. By default the client creates its own
+            on first use of client.scheduler, and stops it when the client stops.
+            Either way, tasks created through client.scheduler are cancelled when the client stops.
+        connect_timeout and dns_timeout limit how long we spend connecting, and on the DNS lookup part
+            of that, in seconds. If we fail to connect, the client stops.
+        dns_cache is the connection.DNSCache to use. By default, one is shared by all clients.
         """
         self.hostname = hostname
         self.port = port
@@ -44,9 +81,23 @@ class Client(object):
         self.password = password
         self.twitch = twitch
 
+        self.keepalive = keepalive
+        self.max_lag = keepalive if max_lag is None else max_lag
+        self.congestion_lag = congestion_lag
+        self._last_recv = time.monotonic()
+        self._ping_tokens = itertools.count()
+        self._scheduler = scheduler
+        self._own_scheduler = scheduler is None
+        self.connect_timeout = connect_timeout
+        self.dns_timeout = dns_timeout
+        self.dns_cache = dns_cache
+        self.connected = gevent.event.Event()
+        self._stopped_event = gevent.event.Event()
+
         self._recv_queue = gevent.queue.Queue()
         self._send_queue = gevent.queue.Queue()
         self._group = gevent.pool.Group()
+        self._handler_group = gevent.pool.Group()
         self._handlers = defaultdict(set)
         self._global_handlers = set()
         self.disconnect_handlers = set()
@@ -56,6 +107,9 @@ class Client(object):
         else:
             self.disconnect_handlers.update(disconnect_handler)
 
+        if keepalive:
+            self.add_handler(self._pong_handler, 'PONG')
+
     def add_handler(self, to_call, *commands):
         """Add callback to be called upon any of *commands being recieved.
         Callback should take args (client, message)
@@ -82,12 +136,24 @@ class Client(object):
     def _handle(self, msg):
         handlers = self._global_handlers | self._handlers[msg.command]
         for handler in handlers:
-            self._group.spawn(handler, self, msg)
+            self._handler_group.spawn(handler, self, msg)
+
+    @property
+    def scheduler(self):
+        """TaskGroup for delayed and periodic tasks, which are cancelled when we stop.
+        See geventirc.scheduler."""
+        if self._tasks is None:
+            if self._scheduler is None:
+                self._scheduler = Scheduler()
+            self._tasks = TaskGroup(self._scheduler)
+        return self._tasks
 
     def send_message(self, message):
         self._send_queue.put(message)
 
     def start(self):
+        """Start connecting in the background. Messages sent before we're connected are queued.
+        Wait on client.connected if you need to know when the connection is up."""
         if self.stopped:
             logger.info("Ignoring start() - already stopped (please create a new Client instead)")
             return
@@ -95,11 +161,7 @@ class Client(object):
             logger.info("Ignoring start() - already started")
             return
         self.started = True
-        logger.info('connecting to %r:%d', self.hostname, self.port)
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.connect((self.hostname, self.port))
-        self._group.spawn(self._send_loop)
-        self._group.spawn(self._recv_loop)
+        self._group.spawn(self._connect)
         if self.twitch:
             self.send_message(message.Message('PASS', [self.password]))
         self.send_message(message.Nick(self.nick))
@@ -109,8 +171,24 @@ class Client(object):
                                            self.server_name,
                                            self.real_name))
 
+    def _connect(self):
+        logger.info('connecting to %r:%d', self.hostname, self.port)
+        try:
+            self._socket = connection.connect(self.hostname, self.port, timeout=self.connect_timeout,
+                                              dns_timeout=self.dns_timeout, cache=self.dns_cache)
+        except Exception:
+            logger.warning("failed to connect to %r:%d", self.hostname, self.port, exc_info=True)
+            self.stop()
+            return
+        self._last_recv = time.monotonic()
+        self._send_greenlet = self._group.spawn(self._send_loop)
+        self._recv_greenlet = self._group.spawn(self._recv_loop)
+        if self.keepalive:
+            self._keepalive_greenlet = self._group.spawn(self._keepalive_loop)
+        self.connected.set()
+
     def _recv_loop(self):
-        partial = ''
+        partial = b''
         try:
             while True:
                 try:
@@ -122,7 +200,8 @@ class Client(object):
                 if not data:
                     logger.info("failed to recv, socket closed")
                     break
-                lines = (partial+data).split('\r\n')
+                self._last_recv = time.monotonic()
+                lines = (partial+data).split(b'\r\n')
                 partial = lines.pop() # everything after final \r\n
                 for line in lines:
                     self._process(line)
@@ -135,43 +214,162 @@ class Client(object):
     def _send_loop(self):
         try:
             while True:
-                message = self._send_queue.get()
-                line = message.encode()
-                logger.debug("Sending message: %r", line)
-                try:
-                    self._socket.sendall(line)
-                except socket.error as ex:
-                    if ex.errno == errno.EPIPE:
-                        logger.info("failed to send, socket closed")
-                        break
-                    raise
-                if message.command == 'QUIT':
+                msg = self._send_queue.get()
+                if msg is None:
+                    # end of drain, everything else is sent so now we can QUIT
+                    self._send(self._deferred_quit or message.Quit(None))
+                    return
+                if msg.command == 'QUIT' and self._draining:
+                    # hold it back until everything else is sent
+                    self._deferred_quit = msg
+                    continue
+                if not self._send(msg):
+                    break
+                if msg.command == 'QUIT':
                     logger.info("QUIT sent, client shutting down")
+                    # if we're already being stopped this returns at once, and we mustn't go on
+                    # to send anything else, such as a second QUIT at the end of a drain
                     self.stop()
+                    return
         except Exception:
             logger.exception("error in _send_loop")
         self.stop()
 
-    def _process(self, line):
+    def _send(self, msg):
+        """Send msg, returning False if the socket was closed"""
+        line = msg.encode()
+        # don't hold back PINGs, they'd measure our own delay rather than the server's
+        if self.congested and msg.command != 'PING':
+            gevent.sleep(self.smoothed_lag)
+        logger.debug("Sending message: %r", line)
+        if msg is self._ping_message:
+            # time the PING from when it's written, not from when it was queued
+            self._ping_sent = time.monotonic()
+        try:
+            self._socket.sendall(line)
+        except socket.error as ex:
+            if ex.errno == errno.EPIPE:
+                logger.info("failed to send, socket closed")
+                return False
+            raise
+        return True
+
+    def _keepalive_loop(self):
+        while True:
+            now = time.monotonic()
+            if self._ping_message is not None:
+                # time it from when it was written, or from when it was queued if it's stuck behind
+                # other messages, eg. because the server has stopped reading and sendall is blocked
+                waited = now - (self._ping_queued if self._ping_sent is None else self._ping_sent)
+                if waited >= self.max_lag:
+                    logger.warning("No PONG after %.1fs, assuming connection is dead", waited)
+                    self.stop()
+                    return
+                gevent.sleep(self.max_lag - waited)
+                continue
+            idle = now - self._last_recv
+            if idle < self.keepalive:
+                gevent.sleep(self.keepalive - idle)
+                continue
+            token = '%s%d' % (PING_TOKEN_PREFIX, next(self._ping_tokens))
+            self._ping_message = message.Message('PING', [token])
+            self._ping_queued = now
+            self.send_message(self._ping_message)
+
+    def _pong_handler(self, client, msg):
+        token = msg.params[-1] if msg.params else ''
+        ping = self._ping_message
+        if ping is None or self._ping_sent is None or token != ping.params[0]:
+            return # not in reply to our outstanding PING
+        lag = time.monotonic() - self._ping_sent
+        self._ping_message = self._ping_sent = None
+        self.last_lag = lag
+        if self.smoothed_lag is None:
+            self.smoothed_lag = lag
+        else:
+            self.smoothed_lag += LAG_SMOOTHING * (lag - self.smoothed_lag)
+        logger.debug("Lag is %.3fs (smoothed %.3fs)", lag, self.smoothed_lag)
+
+    @property
+    def lag(self):
+        """The most recently measured lag, or the time we've been waiting on a PONG if longer.
+        None if keepalive is disabled or we haven't measured it yet."""
+        if self._ping_sent is None:
+            return self.last_lag
+        return max(self.last_lag or 0, time.monotonic() - self._ping_sent)
+
+    @property
+    def congested(self):
+        return (self.congestion_lag is not None and self.smoothed_lag is not None
+                and self.smoothed_lag > self.congestion_lag)
+
+    def _process(self, line, received_at=None):
         logging.debug("Received message: %r", line)
+        if received_at is None:
+            received_at = time.time()
         try:
             msg = message.CTCPMessage.decode(line)
         except Exception:
             logging.warning("Could not decode message from server: %r", line, exc_info=True)
             return
+        # keep the raw line and receive time around for handlers that record traffic
+        msg.line = line
+        msg.received_at = received_at
         self._handle(msg)
 
-    def stop(self):
-        self.stopped = True
-        # we spawn a child greenlet so things don't screw up if current greenlet is in self._group
-        def _stop():
-            self._group.kill()
-            if self._socket is not None:
-                self._socket.close()
-                self._socket = None
-            for fn in self.disconnect_handlers:
-                fn(self)
-        gevent.spawn(_stop).join()
+    def stop(self, drain=False, timeout=None):
+        """Disconnect, killing any running handlers.
+        If drain is True, first stop reading, let running handlers finish, send everything
+        still queued (including anything those handlers send) and then a QUIT.
+        A QUIT already queued by quit() is held back and sent last in place of the default one.
+        timeout limits how long draining can take, after which we stop regardless.
+        """
+        if self._stopping:
+            # someone else is already stopping us, wait for them to finish rather than doing it twice,
+            # unless we're one of the greenlets they're waiting on or about to kill
+            current = gevent.getcurrent()
+            if current not in self._group and current not in self._handler_group:
+                self._stopped_event.wait()
+            return
+        self._stopping = True
+        try:
+            if drain:
+                self._drain(timeout)
+        finally:
+            self.stopped = True
+            # we spawn a child greenlet so things don't screw up if current greenlet is in self._group
+            def _stop():
+                try:
+                    self._group.kill()
+                    self._handler_group.kill()
+                    if self._tasks is not None:
+                        self._tasks.cancel()
+                    if self._own_scheduler and self._scheduler is not None:
+                        self._scheduler.stop()
+                    if self._socket is not None:
+                        self._socket.close()
+                        self._socket = None
+                    for fn in self.disconnect_handlers:
+                        fn(self)
+                finally:
+                    self._stopped_event.set()
+            gevent.spawn(_stop).join()
+
+    def _drain(self, timeout):
+        if self._send_greenlet is None or self._send_greenlet.ready():
+            return # not connected, nothing to flush
+        self._draining = True
+        with gevent.Timeout(timeout, False):
+            for greenlet in (self._recv_greenlet, self._keepalive_greenlet):
+                if greenlet is not None:
+                    greenlet.kill()
+            # we may be being called from a handler, don't wait for ourselves
+            self._handler_group.discard(gevent.getcurrent())
+            self._handler_group.join()
+            self._send_queue.put(None)
+            self._send_greenlet.join()
+            return
+        logger.warning("Timed out after %ss draining client, stopping anyway", timeout)
 
     def join(self):
         """Wait for client to exit"""
@@ -185,3 +383,16 @@ class Client(object):
     def quit(self, msg=None):
         self.send_message(message.Quit(msg))
 
+
+
+def stop_all(clients, drain=True, timeout=None):
+    """Stop all the given clients concurrently, so the time taken doesn't grow with their number.
+    See Client.stop() for drain. timeout applies to all clients together, and is a hard deadline:
+    any still stopping when it expires are killed.
+    """
+    group = gevent.pool.Group()
+    for client in clients:
+        group.spawn(client.stop, drain=drain, timeout=timeout)
+    if not group.join(timeout=timeout):
+        logger.warning("Timed out after %ss stopping %d clients, killing them", timeout, len(group))
+        group.kill()
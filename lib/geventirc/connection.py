@@ -0,0 +1,132 @@
+"""Establishing connections: DNS caching and Happy Eyeballs style connection racing.
+
+connect() resolves a host to all of its addresses, IPv4 and IPv6, then tries them
+in an order that alternates between address families. Rather than waiting for each
+attempt to fail before trying the next, a new attempt is started every attempt_delay
+seconds (or as soon as the previous one fails). The first to connect wins, and the
+others are abandoned. This avoids stalling on dead servers in a round-robin, or on a
+broken IPv6 route.
+"""
+
+from __future__ import absolute_import
+
+import itertools
+import time
+
+import gevent
+import gevent.event
+import gevent.pool
+from gevent import socket
+
+# how long to wait on one connection attempt before starting the next, as recommended by RFC 8305
+ATTEMPT_DELAY = 0.25
+
+
+class DNSCache(object):
+    """Caches resolved addresses for ttl seconds.
+    Concurrent lookups of the same host share a single query.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._entries = {} # {(host, port): (expiry, addrinfos)}
+        self._pending = {} # {(host, port): AsyncResult}
+
+    def resolve(self, host, port, timeout=None):
+        """Return a list of getaddrinfo() results for connecting to (host, port) over TCP"""
+        key = host, port
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        result = self._pending.get(key)
+        if result is None:
+            result = self._pending[key] = gevent.event.AsyncResult()
+            gevent.spawn(self._lookup, key, result)
+        try:
+            return result.get(timeout=timeout)
+        except gevent.Timeout:
+            raise socket.timeout("timed out resolving %s" % host)
+
+    def _lookup(self, key, result):
+        host, port = key
+        try:
+            addrinfos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except Exception as ex:
+            result.set_exception(ex)
+        else:
+            self._entries[key] = time.monotonic() + self.ttl, addrinfos
+            result.set(addrinfos)
+        finally:
+            self._pending.pop(key, None)
+
+    def clear(self):
+        self._entries = {}
+
+
+# shared by default, so clients connecting to the same network only look it up once
+dns_cache = DNSCache()
+
+
+def interleave(addrinfos):
+    """Reorder addresses to alternate between address families, starting with the family of the first"""
+    families = {}
+    for addrinfo in addrinfos:
+        families.setdefault(addrinfo[0], []).append(addrinfo)
+    return [addrinfo for addrinfos in itertools.zip_longest(*families.values())
+            for addrinfo in addrinfos if addrinfo is not None]
+
+def race(addrinfos, attempt_delay=ATTEMPT_DELAY):
+    """Try to connect to each address, staggered by attempt_delay, and return the first connected socket.
+    If all attempts fail, raises the last error.
+    """
+    result = gevent.event.AsyncResult()
+    failed = gevent.event.Event()
+    errors = []
+    attempts = gevent.pool.Group()
+
+    def attempt(addrinfo):
+        family, socktype, proto, canonname, sockaddr = addrinfo
+        sock = socket.socket(family, socktype, proto)
+        try:
+            sock.connect(sockaddr)
+        except socket.error as ex:
+            sock.close()
+            errors.append(ex)
+            failed.set()
+            return
+        except BaseException:
+            sock.close()
+            raise
+        if result.ready():
+            sock.close() # lost the race
+        else:
+            result.set(sock)
+
+    def start_attempts():
+        for addrinfo in addrinfos:
+            failed.clear()
+            attempts.spawn(attempt, addrinfo)
+            failed.wait(attempt_delay)
+            if result.ready():
+                return
+        attempts.join()
+        if not result.ready():
+            result.set_exception(errors[-1] if errors else socket.error("no addresses to connect to"))
+
+    starter = gevent.spawn(start_attempts)
+    try:
+        return result.get()
+    finally:
+        starter.kill()
+        attempts.kill()
+
+def connect(host, port, timeout=None, dns_timeout=None, attempt_delay=ATTEMPT_DELAY, cache=None):
+    """Connect to (host, port) over TCP, using IPv4 or IPv6, and return the socket.
+    timeout covers the whole process, dns_timeout just the lookup.
+    cache is the DNSCache to use, by default one shared by all clients.
+    """
+    if cache is None:
+        cache = dns_cache
+    with gevent.Timeout(timeout, socket.timeout("timed out connecting to %s:%d" % (host, port))):
+        addrinfos = cache.resolve(host, port, timeout=dns_timeout)
+        return race(interleave(addrinfos), attempt_delay)
@@ -1,4 +1,5 @@
-import gevent
+from __future__ import print_function
+
 from geventirc import message
 from geventirc import replycode
 
@@ -8,7 +9,7 @@ def ping_handler(client, msg):
     client.send_message(message.Pong(data))
 
 def print_handler(client, msg):
-    print msg.encode()[:-2]
+    print(msg.encode()[:-2].decode('utf-8', 'replace'))
 
 
 class JoinHandler(object):
@@ -88,31 +89,34 @@ class ReplyToDirectMessage(object):
 
 
 class PeriodicMessage(object):
-    """ Send a message every interval or `wait`
-
-    !!! gevent 1.0 only !!!
+    """ Send msg to channel every `wait` seconds, once connected.
+    Runs on the client's scheduler, see geventirc.scheduler.
+    The same handler may be added to several clients, each gets its own task.
     """
 
     commands = ['001']
 
-    def __init__(self, channel, msg='hello', wait=1.0):
+    def __init__(self, channel, msg='hello', wait=1.0, jitter=0):
         self.channel = channel
-        self.msg = 'hello'
+        self.msg = msg
         self.wait = wait
+        self.jitter = jitter
+        self.tasks = {} # {client: task}
 
-    def start(self, client, msg):
-        self.client = client
-        self._schedule()
-
-    def _schedule(self):
-        timer = gevent.get_hub().loop.timer(self.wait)
-        timer.start(self.__call__)
-
-    def run(self):
-        self.client.msg(self.channel, self.msg)
-    
-    def __call__(self):
-        gevent.spawn(self.run)
-        self._schedule()
-
-
+    def __call__(self, client, msg):
+        # if we see 001 again for the same client, only send once
+        self.stop(client)
+        self.tasks[client] = client.scheduler.call_every(self.wait, self.run, client, jitter=self.jitter,
+                                                         skip_if_running=True)
+        # the client cancels the task itself, this is just so we forget about it
+        client.disconnect_handlers.add(self.stop)
+
+    def run(self, client):
+        client.msg(self.channel, self.msg)
+
+    def stop(self, client=None):
+        """Stop sending to the given client, or by default to all of them"""
+        for client in list(self.tasks) if client is None else [client]:
+            task = self.tasks.pop(client, None)
+            if task is not None:
+                task.cancel()
@@ -1,4 +1,4 @@
 
 # back compat
 
-from client import Client
+from geventirc.client import Client
@@ -1,23 +1,55 @@
-DELIM = chr(040)
-INVALID_CHARS = ["\r", "\n", "\0"]
-CR = "\r"
-NL = "\n"
-NUL = chr(0)
+import re
 
+# Wire data is handled as bytes throughout. Text is only decoded, lazily, when a
+# message's prefix, params etc. are actually read, so params no-one looks at are never decoded.
 
-class ProtocolViolationError(StandardError):
+DELIM = b' '
+INVALID_CHARS = [b"\r", b"\n", b"\0"]
+CR = b"\r"
+NL = b"\n"
+NUL = b"\0"
+
+ENCODING = 'utf-8'
+FALLBACK_ENCODING = 'latin-1'
+
+
+class ProtocolViolationError(Exception):
     pass
 
+def decode_text(data):
+    """Decode bytes from the wire as UTF-8, falling back to latin-1 (which never fails)
+    for clients that still use legacy encodings."""
+    try:
+        return data.decode(ENCODING)
+    except UnicodeDecodeError:
+        return data.decode(FALLBACK_ENCODING)
+
+def encode_text(text):
+    """Encode text for the wire. Bytes are passed through, other non-text values are str()ed first."""
+    if isinstance(text, bytes):
+        return text
+    if not isinstance(text, str):
+        text = str(text)
+    return text.encode(ENCODING)
+
 def is_valid_param(param):
+    param = encode_text(param)
     return not any(c in param for c in INVALID_CHARS)
 
 def irc_split(data):
-    prefix = ''
+    """Split a line (without trailing \\r\\n) into (prefix, command, params), all bytes.
+    data may be bytes, bytearray or memoryview (or text, which is encoded first).
+    prefix is b'' if the line has none.
+    """
+    if isinstance(data, str):
+        data = data.encode(ENCODING)
+    elif not isinstance(data, bytes):
+        data = bytes(data)
+    prefix = b''
     buf = data
     trailing = None
-    command = None
 
-    if buf.startswith(':'):
+    if buf.startswith(b':'):
         try:
             prefix, buf = buf[1:].split(DELIM, 1)
         except ValueError:
@@ -26,8 +58,10 @@ def irc_split(data):
         command, buf = buf.split(DELIM, 1)
     except ValueError:
         raise ProtocolViolationError('no command received: %r' % buf)
+    if buf.startswith(b':'):
+        return prefix, command, [buf[1:]]
     try:
-        buf, trailing = buf.split(DELIM + ':', 1)
+        buf, trailing = buf.split(DELIM + b':', 1)
     except ValueError:
         pass
     params = buf.split(DELIM)
@@ -36,37 +70,91 @@ def irc_split(data):
     return prefix, command, params
 
 def irc_unsplit(prefix, command, params):
-    buf = ''
-    if prefix is not None:
-        buf += prefix + DELIM
+    """Inverse of irc_split. All args are bytes, params may be a list or a single trailing param."""
+    buf = b''
+    if prefix:
+        buf += b':' + prefix + DELIM
     buf += command + DELIM
     if params is None:
         pass
-    elif isinstance(params, basestring):
-        assert not params.startswith(':'), 'params must not start with :'
-        buf += ":" + params
+    elif isinstance(params, bytes):
+        assert not params.startswith(b':'), 'params must not start with :'
+        buf += b":" + params
     else:
         if params:
             rparams, trailing = params[:-1], params[-1]
             if rparams:
                 buf += DELIM.join(rparams) + DELIM
             if trailing:
-                buf += ":" + trailing
+                buf += b":" + trailing
     return buf
 
+def _encode_params(params):
+    if params is None or isinstance(params, (str, bytes)):
+        return None if params is None else encode_text(params)
+    return [encode_text(param) for param in params]
+
 
 class Message(object):
+    """An IRC message. command, prefix and params are text.
+    Messages decoded from the wire keep the raw bytes and only decode prefix and params when first read.
+    """
+
+    _prefix = None
+    _params = None
+    _raw_prefix = None
+    _raw_params = None
 
     @classmethod
     def decode(cls, data):
         prefix, command, params = irc_split(data)
-        return cls(command, params, prefix=prefix)
+        msg = cls.__new__(cls)
+        msg._set_raw(prefix, command, params)
+        return msg
+
+    def _set_raw(self, prefix, command, params):
+        self.command = command.decode(FALLBACK_ENCODING)
+        self._raw_prefix = prefix
+        self._raw_params = params
 
     def __init__(self, command, params, prefix=None):
         self.prefix = prefix
         self.command = command
         self.params = params
 
+    @property
+    def prefix(self):
+        if self._prefix is None and self._raw_prefix is not None:
+            self._prefix = decode_text(self._raw_prefix)
+        return self._prefix
+
+    @prefix.setter
+    def prefix(self, value):
+        self._prefix = value
+        self._raw_prefix = None
+
+    @property
+    def params(self):
+        if self._params is None and self._raw_params is not None:
+            self._params = [decode_text(param) for param in self._raw_params]
+        return self._params
+
+    @params.setter
+    def params(self, value):
+        self._params = value
+        self._raw_params = None
+
+    def _encoded_prefix(self):
+        if self._prefix is None:
+            return self._raw_prefix
+        return encode_text(self._prefix)
+
+    def _encoded_params(self):
+        # once decoded, params may have been modified so always re-encode them
+        if self._params is None:
+            return self._raw_params
+        return _encode_params(self._params)
+
     @property
     def prefix_parts(self):
         """ return tuple(<servername/nick>, <user agent>, <host>)
@@ -97,7 +185,8 @@ class Message(object):
         return self.prefix_parts[2]
 
     def encode(self):
-        return irc_unsplit(self.prefix, self.command, self.params) + "\r\n"
+        return irc_unsplit(self._encoded_prefix(), encode_text(self.command),
+                           self._encoded_params()) + b"\r\n"
 
 
 class Command(Message):
@@ -135,7 +224,7 @@ class Quit(Command):
 class Join(Command):
     def __init__(self, channels, prefix=None):
         params = []
-        if isinstance(channels, basestring):
+        if isinstance(channels, str):
             if channels.startswith('#'):
                 params = channels
             else:
@@ -169,122 +258,141 @@ class Pong(Command):
         super(Pong, self).__init__(params, prefix=prefix)
 
 
-X_DELIM = '\x01'
-X_QUOTE = '\x86'
-M_QUOTE = '\x10'
+X_DELIM = b'\x01'
+X_QUOTE = b'\x86'
+M_QUOTE = b'\x10'
 
 _low_level_quote_table = {
-    NUL: M_QUOTE + '0',
-    NL: M_QUOTE + 'n',
-    CR: M_QUOTE + 'r',
+    NUL: M_QUOTE + b'0',
+    NL: M_QUOTE + b'n',
+    CR: M_QUOTE + b'r',
     M_QUOTE: M_QUOTE * 2
 }
 
 _ctcp_quote_table = {
-    X_DELIM: X_QUOTE + 'a',
+    X_DELIM: X_QUOTE + b'a',
     X_QUOTE: X_QUOTE * 2
 }
 
 _low_level_dequote_table = {v: k for k, v in _low_level_quote_table.items()}
 _ctcp_dequote_table = {v: k for k, v in _ctcp_quote_table.items()}
 
-# TODO clean _quote and _dequote
-def _quote(string, table):
-    cursor = 0
-    buf = ''
-    for pos, char in enumerate(string):
-        if pos is 0:
-            continue
-        if char in table:
-            buf += string[cursor:pos] + table[char]
-            cursor = pos + 1
-    buf += string[cursor:]
-    return buf
-
-def _dequote(string, table):
-    cursor = 0
-    buf = ''
-    last_char = ''
-    for pos, char in enumerate(string):
-        if pos is 0:
-            last_char = char
-            continue
-        if last_char + char in table:
-            buf += string[cursor:pos] + table[last_char + char]
-            cursor = pos + 1
-        last_char = char
-
-    buf += string[cursor:]
-    return buf
-
-def low_level_quote(string):
-    return _quote(string, _low_level_quote_table)
-
-def low_level_dequote(string):
-    return _dequote(string, _low_level_dequote_table)
-
-def ctcp_quote(string):
-    return _quote(string, _ctcp_quote_table)
-
-def ctcp_dequote(string):
-    return _dequote(string, _ctcp_dequote_table)
+def _quoter(table):
+    pattern = re.compile(b'|'.join(re.escape(char) for char in table))
+    return lambda string: pattern.sub(lambda match: table[match.group()], encode_text(string))
+
+def _dequoter(table, quote):
+    # a quote char followed by anything not in the table is dropped
+    pattern = re.compile(re.escape(quote) + b'(.)', re.DOTALL)
+    return lambda string: pattern.sub(lambda match: table.get(match.group(), match.group(1)),
+                                      encode_text(string))
+
+low_level_quote = _quoter(_low_level_quote_table)
+low_level_dequote = _dequoter(_low_level_dequote_table, M_QUOTE)
+ctcp_quote = _quoter(_ctcp_quote_table)
+ctcp_dequote = _dequoter(_ctcp_dequote_table, X_QUOTE)
+
+
+def ctcp_split(data):
+    """Split a line as per irc_split, then undo low-level and CTCP quoting.
+    Returns (prefix, command, params, ctcp_params), all bytes, where params are the
+    space-separated words of any normal (non-CTCP) text and ctcp_params is a list of (tag, data).
+    """
+    prefix, command, params = irc_split(data)
+    extended_messages = []
+    normal_messages = []
+    if params:
+        decoded = low_level_dequote(DELIM.join(params))
+        for index, message in enumerate(decoded.split(X_DELIM)):
+            if not message:
+                continue
+            if index % 2:
+                split = ctcp_dequote(message).split(DELIM, 1)
+                tag = split[0]
+                data = None
+                if len(split) > 1:
+                    data = split[1]
+                extended_messages.append((tag, data))
+            else:
+                normal_messages += [part for part in message.split(DELIM) if part]
+    return prefix, command, normal_messages, extended_messages
 
 
 class CTCPMessage(Message):
+    """A message which may contain CTCP extended messages.
+    Quoting is undone on the raw bytes, before any text decoding.
+    ctcp_params is a list of (tag, data) text tuples, data may be None.
+    """
+
+    _ctcp_params = None
+    _raw_ctcp_params = None
 
     def __init__(self, command, params, ctcp_params, prefix=None):
         super(CTCPMessage, self).__init__(command, params, prefix=prefix)
         self.ctcp_params = ctcp_params
 
+    @property
+    def ctcp_params(self):
+        if self._ctcp_params is None and self._raw_ctcp_params is not None:
+            self._ctcp_params = [(decode_text(tag), None if data is None else decode_text(data))
+                                 for tag, data in self._raw_ctcp_params]
+        return self._ctcp_params
+
+    @ctcp_params.setter
+    def ctcp_params(self, value):
+        self._ctcp_params = value
+        self._raw_ctcp_params = None
+
     @classmethod
     def decode(cls, data):
-        prefix, command, params = irc_split(data)
-        extended_messages = []
-        normal_messages = []
-        if params:
-            params = DELIM.join(params)
-            decoded = low_level_dequote(params)
-            messages = decoded.split(X_DELIM)
-            messages.reverse()
-
-            odd = False
-            extended_messages = []
-            normal_messages = []
-
-            while messages:
-                message = messages.pop()
-                if odd:
-                    if message:
-                        ctcp_decoded = ctcp_dequote(message)
-                        split = ctcp_decoded.split(DELIM, 1)
-                        tag = split[0]
-                        data = None
-                        if len(split) > 1:
-                            data = split[1]
-                        extended_messages.append((tag, data))
-                else:
-                    if message:
-                        normal_messages += filter(None, message.split(DELIM))
-                odd = not odd
-
-        return cls(command, normal_messages, extended_messages, prefix=prefix)
+        prefix, command, params, ctcp_params = ctcp_split(data)
+        msg = cls.__new__(cls)
+        msg._set_raw(prefix, command, params)
+        msg._raw_ctcp_params = ctcp_params
+        return msg
+
+    def _encoded_ctcp_params(self):
+        if self._ctcp_params is None:
+            return self._raw_ctcp_params or []
+        ctcp_params = []
+        for tag, data in self._ctcp_params:
+            if data and not isinstance(data, (str, bytes)):
+                data = ' '.join(map(str, data))
+            ctcp_params.append((encode_text(tag), encode_text(data) if data else None))
+        return ctcp_params
 
     def encode(self):
-        ctcp_buf = ''
-        for tag, data in self.ctcp_params:
-            if data:
-                if not isinstance(data, basestring):
-                    data = DELIM.join(map(str, data))
-                m = tag + DELIM + data
-            else:
-                m = str(tag)
+        ctcp_buf = b''
+        for tag, data in self._encoded_ctcp_params():
+            m = tag + DELIM + data if data else tag
             ctcp_buf += X_DELIM + ctcp_quote(m) + X_DELIM
 
-        return irc_unsplit(
-                self.prefix, self.command, self.params + 
-                [low_level_quote(ctcp_buf)]) + "\r\n"
+        params = self._encoded_params()
+        if params is None:
+            params = []
+        elif isinstance(params, bytes):
+            params = [params]
+        else:
+            params = list(params)
+        if ctcp_buf:
+            params.append(low_level_quote(ctcp_buf))
+        return irc_unsplit(self._encoded_prefix(), encode_text(self.command), params) + b"\r\n"
 
 
 class Me(CTCPMessage):
     def __init__(self, to, action, prefix=None):
         super(Me, self).__init__('PRIVMSG', [to], [('ACTION', action)], prefix=prefix)
+
+
+# The pure-Python implementations are always available as py_*, to test the compiled ones against.
+py_irc_split = irc_split
+py_ctcp_split = ctcp_split
+
+try:
+    from geventirc import _speedups
+except ImportError:
+    _speedups = None
+else:
+    _speedups.ProtocolViolationError = ProtocolViolationError
+    irc_split = _speedups.irc_split
+    ctcp_split = _speedups.ctcp_split
@@ -0,0 +1,176 @@
+"""Offline replay of recorded traffic through a client's handlers.
+
+A replay client never opens a socket. Lines are fed straight into _process, so handlers
+(and for ReplayAutoClient, the AutoClient state tracking) see exactly what they would
+see from a server. Anything the handlers send is captured in client.sent instead.
+
+Example:
+    client = ReplayAutoClient('mybot', 'channel.log')
+    client.add_handler(my_handler, 'PRIVMSG')
+    client.run()
+    print(client.format_stats())
+    assert client.sent[0].command == 'PRIVMSG'
+"""
+
+from __future__ import absolute_import
+
+import logging
+import os
+import time
+
+import gevent
+
+from geventirc import client, autoclient, chanlog
+
+logger = logging.getLogger(__name__)
+
+
+class HandlerStats(object):
+    """Call count, errors and total time spent in one handler"""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        """Calls per second of handler time"""
+        return self.calls / self.elapsed if self.elapsed else float('inf')
+
+    def __repr__(self):
+        return "<HandlerStats %s: %d calls, %d errors, %.3fs, %.0f/s>" % (
+                self.name, self.calls, self.errors, self.elapsed, self.rate)
+
+
+def _handler_name(handler):
+    return getattr(handler, '__name__', None) or type(handler).__name__
+
+def iter_source(source):
+    """Yield (timestamp, line) from source, which may be:
+        * the path to a chanlog directory, which is opened read-only
+        * the path to a file of raw lines
+        * an open file of raw lines
+        * an iterable of raw lines, (timestamp, line) or (timestamp, channel, line) tuples,
+          eg. the output of chanlog.SegmentLog.search()
+    timestamp is None where the source doesn't record one.
+    """
+    if isinstance(source, (str, bytes)):
+        if os.path.isdir(source):
+            log = chanlog.SegmentLog(source, readonly=True)
+            try:
+                for timestamp, channel, line in log.search():
+                    yield timestamp, line
+            finally:
+                log.close()
+            return
+        with open(source, 'rb') as f:
+            for item in iter_source(f):
+                yield item
+        return
+    for item in source:
+        if isinstance(item, tuple):
+            yield item[0], item[-1]
+        else:
+            yield None, item.rstrip(b'\r\n' if isinstance(item, bytes) else '\r\n')
+
+
+class ReplayMixin(object):
+    """Replaces the network side of a Client with a recorded source of lines.
+
+    speed: None to replay as fast as possible, without ever sleeping. Handlers are then called
+        synchronously and in order, so state is consistent after each line.
+        Otherwise, the replay is paced according to the recorded timestamps, scaled by speed
+        (1.0 is real time), and handlers are spawned as they would be by a live client.
+    """
+
+    def __init__(self, nick, source, speed=None, **kwargs):
+        kwargs.setdefault('local_hostname', 'localhost')
+        super(ReplayMixin, self).__init__('replay', nick, **kwargs)
+        self.source = source
+        self.speed = speed
+        self.sent = []
+        self.stats = {}
+        self.lines = 0
+        self.elapsed = 0.0
+
+    def send_message(self, message):
+        self.sent.append(message)
+
+    def start(self):
+        """Replay the whole source in a new greenlet"""
+        if self.stopped or self.started:
+            logger.info("Ignoring start() - already started or stopped")
+            return
+        self.started = True
+        # not in any of our groups, so that stop() killing them doesn't kill the replay mid-way
+        gevent.spawn(self._replay)
+
+    def run(self):
+        """Replay the whole source and wait for all handlers to finish"""
+        self.start()
+        self.join()
+        return self.stats
+
+    def _replay(self):
+        first_timestamp = None
+        start = time.time()
+        try:
+            for timestamp, line in iter_source(self.source):
+                if self.stopped:
+                    break
+                if self.speed is not None and timestamp is not None:
+                    if first_timestamp is None:
+                        first_timestamp = timestamp
+                    delay = start + (timestamp - first_timestamp) / self.speed - time.time()
+                    if delay > 0:
+                        gevent.sleep(delay)
+                self._process(line, received_at=timestamp)
+                self.lines += 1
+            self._handler_group.join()
+        except Exception:
+            logger.exception("error in replay")
+        self.elapsed = time.time() - start
+        self.stop()
+
+    def _handle(self, msg):
+        handlers = self._global_handlers | self._handlers[msg.command]
+        for handler in handlers:
+            if self.speed is None:
+                self._call_handler(handler, msg)
+            else:
+                self._handler_group.spawn(self._call_handler, handler, msg)
+
+    def _call_handler(self, handler, msg):
+        stats = self.stats.get(handler)
+        if stats is None:
+            stats = self.stats[handler] = HandlerStats(_handler_name(handler))
+        start = time.time()
+        try:
+            handler(self, msg)
+        except Exception:
+            stats.errors += 1
+            logger.exception("error in handler %s for %r", stats.name, msg.command)
+        finally:
+            stats.calls += 1
+            stats.elapsed += time.time() - start
+
+    def format_stats(self):
+        """Return a human-readable throughput report, slowest handlers first"""
+        rate = self.lines / self.elapsed if self.elapsed else float('inf')
+        lines = ["%d lines in %.3fs (%.0f lines/s)" % (self.lines, self.elapsed, rate)]
+        for stats in sorted(self.stats.values(), key=lambda s: s.elapsed, reverse=True):
+            lines.append("  %-30s %8d calls %6d errors %8.3fs %10.0f/s" % (
+                    stats.name, stats.calls, stats.errors, stats.elapsed, stats.rate))
+        return '\n'.join(lines)
+
+
+class ReplayClient(ReplayMixin, client.Client):
+    pass
+
+
+class ReplayAutoClient(ReplayMixin, autoclient.AutoClient):
+
+    def _authenticate(self):
+        pass
@@ -0,0 +1,200 @@
+"""A shared scheduler for delayed and periodic tasks.
+
+All tasks live in one heap, driven by a single greenlet, instead of each
+having its own hub timer. Each run of a task is spawned in its own greenlet
+so slow tasks don't hold up the others.
+
+Every Client has a scheduler (client.scheduler). Pass the same Scheduler to
+several clients to share one between them. client.scheduler is a TaskGroup on
+that Scheduler, so the tasks a client creates are cancelled when it stops, even
+if the Scheduler itself carries on for the others.
+
+Example:
+    task = client.scheduler.call_every(60, client.msg, '#chan', 'still here', jitter=5)
+    ...
+    task.cancel()
+"""
+
+from __future__ import absolute_import
+
+import heapq
+import itertools
+import logging
+import random
+import time
+import weakref
+
+import gevent
+import gevent.event
+import gevent.pool
+
+logger = logging.getLogger(__name__)
+
+
+class Task(object):
+    """A scheduled call, as returned by Scheduler.call_later and Scheduler.call_every.
+    interval is None for one-off tasks.
+    runs and skipped count how many times the task has been run, or skipped
+    because the previous run was still going (see skip_if_running).
+    """
+
+    def __init__(self, fn, args, kwargs, interval=None, jitter=0, skip_if_running=False, scheduler=None):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.jitter = jitter
+        self.skip_if_running = skip_if_running
+        self.cancelled = False
+        self.next_run = None # when the task is next due, before jitter
+        self.greenlet = None
+        self.runs = 0
+        self.skipped = 0
+        self.scheduler = scheduler
+        self.queued = False # whether it's in the scheduler's heap
+
+    def cancel(self):
+        """Stop the task from running again. Does not interrupt a run in progress."""
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.queued and self.scheduler is not None:
+            self.scheduler._cancelled(self)
+
+    @property
+    def running(self):
+        return self.greenlet is not None and not self.greenlet.ready()
+
+    def _run(self):
+        try:
+            self.fn(*self.args, **self.kwargs)
+        except Exception:
+            logger.exception("Error in scheduled task %r", self.fn)
+
+
+class Scheduler(object):
+
+    def __init__(self):
+        self._heap = [] # [(when, seq, task)]
+        self._cancelled_count = 0 # cancelled tasks still in the heap
+        self._seq = itertools.count()
+        self._wakeup = gevent.event.Event()
+        self._group = gevent.pool.Group()
+        self._driver = None
+        self.stopped = False
+
+    def _jittered(self, when, jitter):
+        if jitter:
+            when += random.uniform(0, jitter)
+        return when
+
+    def _push(self, when, task):
+        if self.stopped:
+            raise ValueError("Scheduler is stopped")
+        task.next_run = when
+        task.queued = True
+        heapq.heappush(self._heap, (self._jittered(when, task.jitter), next(self._seq), task))
+        if self._driver is None:
+            self._driver = gevent.spawn(self._run)
+        elif self._heap[0][2] is task:
+            # new earliest task, so the driver needs to wake up sooner
+            self._wakeup.set()
+
+    def call_later(self, delay, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) once, after delay seconds. Returns a Task."""
+        task = Task(fn, args, kwargs, scheduler=self)
+        self._push(time.monotonic() + delay, task)
+        return task
+
+    def call_every(self, interval, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) every interval seconds. Returns a Task.
+        Takes the following extra kwargs:
+            delay: seconds until the first call. Defaults to interval.
+            jitter: add a random delay of up to this many seconds to each call,
+                so tasks started together don't all run together.
+            skip_if_running: if the previous call is still running when the next is due,
+                skip the new one rather than running both at once.
+        """
+        delay = kwargs.pop('delay', interval)
+        jitter = kwargs.pop('jitter', 0)
+        skip_if_running = kwargs.pop('skip_if_running', False)
+        task = Task(fn, args, kwargs, interval=interval, jitter=jitter, skip_if_running=skip_if_running,
+                    scheduler=self)
+        self._push(time.monotonic() + delay, task)
+        return task
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                when, seq, task = heapq.heappop(self._heap)
+                task.queued = False
+                if task.cancelled:
+                    self._cancelled_count -= 1
+                    continue
+                if task.skip_if_running and task.running:
+                    task.skipped += 1
+                else:
+                    task.runs += 1
+                    task.greenlet = self._group.spawn(task._run)
+                if task.interval is not None:
+                    # keep to the original schedule, unless we've fallen behind it
+                    self._push(max(task.next_run + task.interval, now), task)
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def _cancelled(self, task):
+        # cancelled tasks are skipped when they come due, but until then they hold on to their fn
+        # and args, so once they make up half the heap, clear them out
+        self._cancelled_count += 1
+        if self._cancelled_count > len(self._heap) // 2:
+            live = []
+            for entry in self._heap:
+                if entry[2].cancelled:
+                    entry[2].queued = False
+                else:
+                    live.append(entry)
+            heapq.heapify(live)
+            self._heap = live
+            self._cancelled_count = 0
+
+    def stop(self):
+        """Cancel all tasks and kill any that are running"""
+        self.stopped = True
+        heap, self._heap = self._heap, []
+        for when, seq, task in heap:
+            task.queued = False
+            task.cancel()
+        self._cancelled_count = 0
+        if self._driver is not None:
+            self._driver.kill()
+        self._group.kill()
+
+
+class TaskGroup(object):
+    """Creates tasks on a Scheduler and keeps track of them, so they can be cancelled together
+    without stopping the Scheduler, which may be shared.
+    Has the same call_later and call_every methods as Scheduler.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        # weak, so tasks that are finished, or cancelled and dropped by the scheduler, don't pile up here
+        self._tasks = weakref.WeakSet()
+
+    def call_later(self, delay, fn, *args, **kwargs):
+        task = self.scheduler.call_later(delay, fn, *args, **kwargs)
+        self._tasks.add(task)
+        return task
+
+    def call_every(self, interval, fn, *args, **kwargs):
+        task = self.scheduler.call_every(interval, fn, *args, **kwargs)
+        self._tasks.add(task)
+        return task
+
+    def cancel(self):
+        """Cancel all our tasks"""
+        for task in list(self._tasks):
+            task.cancel()
+        self._tasks = weakref.WeakSet()
@@ -0,0 +1,315 @@
+"""Run many clients across several worker processes.
+
+One gevent hub only uses one core, so a large number of bots can be CPU-bound on parsing
+and dispatch. A Supervisor starts a number of worker processes (by default one per core)
+and shards bots across them. It talks to each worker over a control channel on the
+worker's stdin/stdout, one JSON object per line, to add and remove bots, route outbound
+messages to the worker that owns a bot, and collect metrics. Workers that die are restarted
+with the bots they owned; other workers are unaffected.
+
+Bots are described by a factory, given as "module:callable" (eg. "geventirc.autoclient:AutoClient"),
+plus args and kwargs, all of which must be JSON-serializable. The factory is called in the
+worker to create the client, which is then started.
+
+Example:
+    supervisor = Supervisor(workers=4)
+    supervisor.start()
+    supervisor.add_bot('bot1', 'geventirc.autoclient:AutoClient', 'irc.example.com', 'bot1',
+                       port=6667, channels=['#foo'])
+    supervisor.send_message('bot1', message.PrivMsg('#foo', 'hello'))
+    print(supervisor.metrics())
+    supervisor.stop()
+"""
+
+from __future__ import absolute_import
+
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+from importlib import import_module
+
+import gevent
+import gevent.event
+import gevent.lock
+import gevent.pool
+from gevent import subprocess
+from gevent.fileobject import FileObject
+
+from geventirc import message
+from geventirc.client import stop_all
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerError(Exception):
+    """A request to a worker failed, or the worker died before answering"""
+    pass
+
+
+def _encode(obj):
+    return json.dumps(obj).encode('utf-8') + b'\n'
+
+def _decode(line):
+    return json.loads(line.decode('utf-8'))
+
+def load_factory(factory):
+    """Resolve a "module:callable" string"""
+    module, name = factory.split(':', 1)
+    return getattr(import_module(module), name)
+
+
+class Worker(object):
+    """The worker process side. Owns a set of clients and serves requests from the supervisor."""
+
+    def __init__(self, infile, outfile):
+        self.infile = infile
+        self.outfile = outfile
+        self.clients = {}
+        self.lines = 0
+        self._write_lock = gevent.lock.Semaphore()
+
+    def serve(self):
+        """Serve requests until the supervisor closes our stdin"""
+        while True:
+            line = self.infile.readline()
+            if not line:
+                break
+            gevent.spawn(self._dispatch, _decode(line))
+        stop_all(self.clients.values(), drain=False)
+
+    def _dispatch(self, request):
+        reply = {'seq': request['seq']}
+        try:
+            reply['result'] = getattr(self, 'do_' + request['op'])(**request['args'])
+        except Exception as ex:
+            logger.exception("Request %r failed", request)
+            reply['error'] = '%s: %s' % (type(ex).__name__, ex)
+        with self._write_lock:
+            self.outfile.write(_encode(reply))
+            self.outfile.flush()
+
+    def _count(self, client, msg):
+        self.lines += 1
+
+    def do_add(self, bot_id, factory, args, kwargs):
+        if bot_id in self.clients:
+            raise ValueError("Bot %r already exists" % bot_id)
+        client = load_factory(factory)(*args, **kwargs)
+        client.add_handler(self._count)
+        self.clients[bot_id] = client
+        client.start()
+
+    def do_remove(self, bot_id):
+        self.clients.pop(bot_id).stop()
+
+    def do_send(self, bot_id, command, params, prefix=None, ctcp_params=None):
+        if ctcp_params:
+            msg = message.CTCPMessage(command, params, ctcp_params, prefix=prefix)
+        else:
+            msg = message.Message(command, params, prefix=prefix)
+        self.clients[bot_id].send_message(msg)
+
+    def do_shutdown(self, drain, deadline):
+        stop_all(self.clients.values(), drain=drain, timeout=deadline)
+
+    def do_metrics(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            'pid': os.getpid(),
+            'bots': len(self.clients),
+            'running': sum(1 for client in self.clients.values() if not client.stopped),
+            'lines': self.lines,
+            'queued': sum(client._send_queue.qsize() for client in self.clients.values()),
+            'cpu': usage.ru_utime + usage.ru_stime,
+        }
+
+
+def worker_main():
+    # keep the real stdout for the control channel, and send anything else that's printed to stderr
+    outfile = FileObject(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    infile = FileObject(os.dup(0), 'rb')
+    Worker(infile, outfile).serve()
+
+
+class WorkerProcess(object):
+    """The supervisor side of one worker process"""
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self._seq = 0
+        self._pending = {}
+        self._write_lock = gevent.lock.Semaphore()
+
+    def start(self):
+        env = dict(os.environ)
+        # make sure the worker can import us even if we aren't installed
+        lib_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [lib_path, env.get('PYTHONPATH')]))
+        self.process = subprocess.Popen([sys.executable, '-m', 'geventirc.shard'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        gevent.spawn(self._read_loop, self.process)
+
+    def _read_loop(self, process):
+        while True:
+            line = process.stdout.readline()
+            if not line:
+                break
+            reply = _decode(line)
+            result = self._pending.pop(reply['seq'], None)
+            if result is None:
+                continue
+            if 'error' in reply:
+                result.set_exception(WorkerError(reply['error']))
+            else:
+                result.set(reply.get('result'))
+        pending, self._pending = self._pending, {}
+        for result in pending.values():
+            result.set_exception(WorkerError("Worker %d died" % self.index))
+
+    def call(self, op, timeout=None, **args):
+        """Make a request to the worker and wait for its result"""
+        if self.process is None or self.process.poll() is not None:
+            raise WorkerError("Worker %d is not running" % self.index)
+        self._seq += 1
+        result = self._pending[self._seq] = gevent.event.AsyncResult()
+        try:
+            with self._write_lock:
+                self.process.stdin.write(_encode({'seq': self._seq, 'op': op, 'args': args}))
+                self.process.stdin.flush()
+        except (IOError, OSError):
+            self._pending.pop(self._seq, None)
+            raise WorkerError("Worker %d died" % self.index)
+        return result.get(timeout=timeout)
+
+    def stop(self, timeout=5):
+        """Ask the worker to exit by closing its stdin, killing it if it takes too long"""
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class Supervisor(object):
+    """Shards bots across worker processes and restarts workers that die.
+
+    workers: number of worker processes, defaults to the number of cores
+    restart_delay: seconds to wait before restarting a dead worker
+    timeout: default timeout for requests to workers
+    """
+
+    def __init__(self, workers=None, restart_delay=1.0, timeout=30):
+        self.restart_delay = restart_delay
+        self.timeout = timeout
+        self.workers = [WorkerProcess(index) for index in range(workers or multiprocessing.cpu_count())]
+        self.bots = {} # {bot_id: (worker, spec)}
+        self._adding = set() # bot_ids whose add request hasn't been answered yet
+        self._ready = [gevent.event.Event() for worker in self.workers]
+        self._group = gevent.pool.Group()
+        self.started = False
+        self.stopped = False
+
+    def start(self):
+        if self.started:
+            logger.info("Ignoring start() - already started")
+            return
+        self.started = True
+        for worker in self.workers:
+            worker.start()
+            self._ready[worker.index].set()
+            self._group.spawn(self._monitor, worker)
+
+    def _monitor(self, worker):
+        while True:
+            worker.process.wait()
+            if self.stopped:
+                return
+            logger.warning("Worker %d exited with %r, restarting", worker.index, worker.process.returncode)
+            self._ready[worker.index].clear()
+            gevent.sleep(self.restart_delay)
+            worker.start()
+            for bot_id, (owner, spec) in list(self.bots.items()):
+                # bots still being added will be added by add_bot once the worker is ready
+                if owner is worker and bot_id not in self._adding:
+                    try:
+                        worker.call('add', timeout=self.timeout, bot_id=bot_id, **spec)
+                    except WorkerError:
+                        logger.exception("Failed to restore bot %r on worker %d", bot_id, worker.index)
+            self._ready[worker.index].set()
+
+    def _call(self, worker, op, **args):
+        self._ready[worker.index].wait(self.timeout)
+        return worker.call(op, timeout=self.timeout, **args)
+
+    def add_bot(self, bot_id, factory, *args, **kwargs):
+        """Create and start a bot on the least loaded worker.
+        factory is a "module:callable" string, called with *args and **kwargs in the worker.
+        """
+        if bot_id in self.bots:
+            raise ValueError("Bot %r already exists" % bot_id)
+        load = {worker: 0 for worker in self.workers}
+        for owner, spec in self.bots.values():
+            load[owner] += 1
+        worker = min(self.workers, key=lambda worker: load[worker])
+        spec = {'factory': factory, 'args': list(args), 'kwargs': kwargs}
+        self.bots[bot_id] = worker, spec
+        self._adding.add(bot_id)
+        try:
+            self._call(worker, 'add', bot_id=bot_id, **spec)
+        except Exception:
+            del self.bots[bot_id]
+            raise
+        finally:
+            self._adding.discard(bot_id)
+
+    def remove_bot(self, bot_id):
+        worker, spec = self.bots.pop(bot_id)
+        self._call(worker, 'remove', bot_id=bot_id)
+
+    def send_message(self, bot_id, msg):
+        """Have the given bot send msg, which may be a Message or CTCPMessage"""
+        worker, spec = self.bots[bot_id]
+        self._call(worker, 'send', bot_id=bot_id, command=msg.command, params=msg.params,
+                   prefix=msg.prefix, ctcp_params=getattr(msg, 'ctcp_params', None))
+
+    def metrics(self):
+        """Return a list of metrics dicts, one per worker, or None for workers that didn't answer"""
+        def get(worker):
+            try:
+                return self._call(worker, 'metrics')
+            except (WorkerError, gevent.Timeout):
+                return None
+        return gevent.pool.Group().map(get, self.workers)
+
+    def stop(self, drain=False, timeout=None):
+        """Stop all bots and workers.
+        With drain=True, bots are stopped gracefully as per Client.stop(drain=True), all at once
+        across all workers, with timeout as a deadline for the whole fleet.
+        """
+        self.stopped = True
+        self._group.kill()
+        def stop_worker(worker):
+            if drain:
+                try:
+                    # allow a little longer than the drain itself for the request to round-trip
+                    call_timeout = None if timeout is None else timeout + 5
+                    worker.call('shutdown', timeout=call_timeout, drain=True, deadline=timeout)
+                except (WorkerError, gevent.Timeout):
+                    logger.warning("Worker %d failed to drain", worker.index, exc_info=True)
+            worker.stop()
+        gevent.pool.Group().map(stop_worker, self.workers)
+
+
+if __name__ == '__main__':
+    worker_main()
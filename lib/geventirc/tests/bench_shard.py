@@ -0,0 +1,59 @@
+"""Benchmark how Supervisor throughput scales with the number of worker processes.
+
+Usage: python -m geventirc.tests.bench_shard [BOTS [LINES [MAX_WORKERS]]]
+
+For each worker count from 1 up to MAX_WORKERS (default: number of cores), runs BOTS bots,
+each of which is sent LINES lines by one of a matching number of fake ircd processes,
+and reports the rate at which lines are processed.
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+
+import gevent
+from gevent import subprocess
+
+from geventirc import shard
+
+
+def start_ircd(lines):
+    lib_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=lib_path)
+    proc = subprocess.Popen([sys.executable, '-m', 'geventirc.tests.fakeircd', str(lines)],
+                            stdout=subprocess.PIPE, env=env)
+    return proc, int(proc.stdout.readline())
+
+def run(workers, bots, lines):
+    ircds = [start_ircd(lines) for i in range(workers)]
+    supervisor = shard.Supervisor(workers=workers)
+    supervisor.start()
+    try:
+        start = time.time()
+        for i in range(bots):
+            proc, port = ircds[i % workers]
+            supervisor.add_bot('bot%d' % i, 'geventirc.client:Client', '127.0.0.1', 'bot%d' % i,
+                               port=port, local_hostname='localhost')
+        expected = bots * (lines + 1)
+        while sum(m['lines'] for m in supervisor.metrics() if m) < expected:
+            gevent.sleep(0.1)
+        return expected / (time.time() - start)
+    finally:
+        supervisor.stop()
+        for proc, port in ircds:
+            proc.kill()
+            proc.wait()
+
+def main(bots=100, lines=10000, max_workers=None):
+    max_workers = max_workers or multiprocessing.cpu_count()
+    base = None
+    for workers in range(1, max_workers + 1):
+        rate = run(workers, bots, lines)
+        base = base or rate
+        sys.stdout.write("%2d workers: %10.0f lines/s (%.2fx)\n" % (workers, rate, rate / base))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,62 @@
+"""A minimal fake IRC server for tests and benchmarks.
+
+Every connection is sent 001 followed by a fixed number of channel messages, then
+kept open until the client disconnects. Lines sent by clients are recorded, and PINGs
+are answered while self.pong is True. While self.read is False, nothing is read from
+clients at all, as for a server that has hung.
+
+Run as "python -m geventirc.tests.fakeircd LINES" to serve from a separate process,
+in which case the listening port is printed to stdout.
+"""
+
+import sys
+
+import gevent
+from gevent.server import StreamServer
+
+
+class FakeIRCd(object):
+
+    def __init__(self, lines=1000, port=0):
+        self.lines = lines
+        self.received = []
+        self.pong = True
+        self.read = True
+        line = b':someone!user@host PRIVMSG #bench :the quick brown fox jumps over the lazy dog\r\n'
+        self.data = b':fake.server 001 bot :Welcome\r\n' + line * lines
+        self.server = StreamServer(('127.0.0.1', port), self._handle)
+
+    @property
+    def port(self):
+        return self.server.server_port
+
+    def start(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop()
+
+    def _handle(self, sock, address):
+        sock.sendall(self.data)
+        partial = b''
+        while True:
+            if not self.read:
+                gevent.sleep(0.05)
+                continue
+            data = sock.recv(4096)
+            if not data:
+                break
+            lines = (partial + data).split(b'\r\n')
+            partial = lines.pop()
+            self.received += lines
+            for line in lines:
+                if self.pong and line.startswith(b'PING :'):
+                    sock.sendall(b':fake.server PONG fake.server :' + line[len(b'PING :'):] + b'\r\n')
+
+
+if __name__ == '__main__':
+    ircd = FakeIRCd(int(sys.argv[1]))
+    ircd.start()
+    sys.stdout.write('%d\n' % ircd.port)
+    sys.stdout.flush()
+    gevent.wait()
@@ -0,0 +1,114 @@
+
+import os
+import shutil
+import tempfile
+
+import gevent
+import pytest
+
+from geventirc import chanlog
+
+
+def _write_some(log):
+    log.append(':a!u@h PRIVMSG #foo :one', '#foo', timestamp=100.0)
+    log.append(':b!u@h PRIVMSG #bar :two', '#bar', timestamp=200.0)
+    log.append(':a!u@h PRIVMSG #foo :three', '#foo', timestamp=4000.0)
+    log.append(':server 001 nick :welcome', timestamp=4100.0)
+    log.flush()
+
+def test_search_by_channel_and_time():
+    path = tempfile.mkdtemp()
+    try:
+        log = chanlog.SegmentLog(path, bucket_size=1000)
+        _write_some(log)
+        lines = [line for ts, channel, line in log.search(channel='#foo')]
+        assert lines == [b':a!u@h PRIVMSG #foo :one', b':a!u@h PRIVMSG #foo :three']
+        lines = [line for ts, channel, line in log.search(start=150, end=4050)]
+        assert lines == [b':b!u@h PRIVMSG #bar :two', b':a!u@h PRIVMSG #foo :three']
+        log.close()
+    finally:
+        shutil.rmtree(path)
+
+def test_rotation_and_compression():
+    path = tempfile.mkdtemp()
+    try:
+        log = chanlog.SegmentLog(path, segment_size=60, compress=True)
+        _write_some(log)
+        assert len(log.segments) >= 2
+        assert all(segment.compressed for segment in log.segments)
+        log.close()
+        # reopening loads sealed indexes and rebuilds the unsealed one
+        log = chanlog.SegmentLog(path, segment_size=60, compress=True)
+        records = list(log.search())
+        assert [ts for ts, channel, line in records] == [100.0, 200.0, 4000.0, 4100.0]
+        assert records[-1][1] == chanlog.NO_CHANNEL
+        log.close()
+    finally:
+        shutil.rmtree(path)
+
+def test_recovers_from_partial_write():
+    path = tempfile.mkdtemp()
+    try:
+        log = chanlog.SegmentLog(path, bucket_size=1000)
+        _write_some(log)
+        filename = log.active.filename
+        log.close()
+        with open(filename, 'ab') as f:
+            f.write(b'4200.000000 #foo :a!u@h PRIV')
+        # the partial record is dropped, and new records are appended after the last good one
+        log = chanlog.SegmentLog(path, bucket_size=1000)
+        log.append(':a!u@h PRIVMSG #foo :four', '#foo', timestamp=4300.0)
+        log.flush()
+        expected = [b':a!u@h PRIVMSG #foo :one', b':a!u@h PRIVMSG #foo :three', b':a!u@h PRIVMSG #foo :four']
+        assert [line for ts, channel, line in log.search(channel='#foo')] == expected
+        log.close()
+        log = chanlog.SegmentLog(path, bucket_size=1000)
+        assert [line for ts, channel, line in log.search(channel='#foo')] == expected
+        log.close()
+    finally:
+        shutil.rmtree(path)
+
+def test_readonly_changes_nothing():
+    path = tempfile.mkdtemp()
+    try:
+        log = chanlog.SegmentLog(path, bucket_size=1000)
+        _write_some(log)
+        filename = log.active.filename
+        with open(filename, 'ab') as f:
+            f.write(b'4200.000000 #foo :a!u@h PRIV')
+        size = os.path.getsize(filename)
+        reader = chanlog.SegmentLog(path, bucket_size=1000, readonly=True)
+        assert len(list(reader.search())) == 4
+        with pytest.raises(ValueError):
+            reader.append(':a!u@h PRIVMSG #foo :four', '#foo')
+        reader.close()
+        # the partial record may still be being written, so it is left alone
+        assert os.path.getsize(filename) == size
+        log.close()
+        with pytest.raises(OSError):
+            chanlog.SegmentLog(os.path.join(path, 'missing'), readonly=True)
+        assert not os.path.exists(os.path.join(path, 'missing'))
+    finally:
+        shutil.rmtree(path)
+
+def test_rotate_while_writing():
+    path = tempfile.mkdtemp()
+    try:
+        log = chanlog.SegmentLog(path, flush_interval=0.001)
+        log.rotate() # nothing written yet, so nothing to seal
+        assert not log.segments
+        def writer():
+            for i in range(200):
+                log.append(':a!u@h PRIVMSG #foo :%d' % i, '#foo', timestamp=float(i))
+                gevent.sleep(0.001)
+        writing = gevent.spawn(writer)
+        while not writing.ready():
+            log.rotate()
+            gevent.sleep(0)
+        log.close()
+        log = chanlog.SegmentLog(path)
+        assert len(log.segments) > 1
+        assert [ts for ts, channel, line in log.search()] == [float(i) for i in range(200)]
+        log.close()
+    finally:
+        shutil.rmtree(path)
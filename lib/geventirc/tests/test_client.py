@@ -0,0 +1,157 @@
+
+import gevent
+import gevent.event
+
+from geventirc import client
+from geventirc.tests.fakeircd import FakeIRCd
+
+
+def test_keepalive_measures_lag_and_detects_dead_connection():
+    ircd = FakeIRCd(lines=0)
+    ircd.start()
+    irc = client.Client('127.0.0.1', 'bot', port=ircd.port, local_hostname='localhost',
+                        keepalive=0.1, max_lag=0.3)
+    try:
+        irc.start()
+        with gevent.Timeout(5):
+            while irc.smoothed_lag is None:
+                gevent.sleep(0.05)
+        assert 0 <= irc.lag < 0.3
+        # a healthy connection survives many keepalive cycles
+        with gevent.Timeout(5):
+            while len([line for line in ircd.received if line.startswith(b'PING')]) < 10:
+                gevent.sleep(0.05)
+        assert not irc.stopped
+        ircd.pong = False
+        with gevent.Timeout(5):
+            while not irc.stopped:
+                gevent.sleep(0.05)
+    finally:
+        irc.stop()
+        ircd.stop()
+
+def test_keepalive_detects_server_that_stopped_reading():
+    ircd = FakeIRCd(lines=0)
+    ircd.start()
+    irc = client.Client('127.0.0.1', 'bot', port=ircd.port, local_hostname='localhost',
+                        keepalive=0.2, max_lag=0.5)
+    try:
+        irc.start()
+        irc.connected.wait(5)
+        ircd.read = False
+        # fill the socket buffers so sendall blocks and the PING never gets written
+        for i in range(20000):
+            irc.msg('#chan', 'x' * 400)
+        with gevent.Timeout(5):
+            while not irc.stopped:
+                gevent.sleep(0.05)
+    finally:
+        irc.stop()
+        ircd.stop()
+
+def test_drain_flushes_queue_and_quits_last():
+    ircd = FakeIRCd(lines=1)
+    ircd.start()
+    irc = client.Client('127.0.0.1', 'bot', port=ircd.port, local_hostname='localhost')
+    @irc.handler('PRIVMSG')
+    def slow_reply(irc, msg):
+        gevent.sleep(0.1)
+        irc.msg('#chan', 'slow reply')
+    try:
+        irc.start()
+        with gevent.Timeout(5):
+            while not irc._handler_group:
+                gevent.sleep(0.01)
+        for i in range(3):
+            irc.msg('#chan', 'queued %d' % i)
+        irc.quit('bye')
+        irc.stop(drain=True, timeout=5)
+        assert irc.stopped
+        with gevent.Timeout(5):
+            while not ircd.received or not ircd.received[-1].startswith(b'QUIT'):
+                gevent.sleep(0.01)
+        sent = [line for line in ircd.received if line.startswith((b'PRIVMSG', b'QUIT'))]
+        assert sent == [b'PRIVMSG #chan :queued 0', b'PRIVMSG #chan :queued 1', b'PRIVMSG #chan :queued 2',
+                        b'PRIVMSG #chan :slow reply', b'QUIT :bye']
+    finally:
+        irc.stop()
+        ircd.stop()
+
+def test_drain_after_quit_taken_from_queue_quits_once():
+    ircd = FakeIRCd(lines=0)
+    ircd.start()
+    irc = client.Client('127.0.0.1', 'bot', port=ircd.port, local_hostname='localhost',
+                        congestion_lag=0)
+    try:
+        irc.start()
+        irc.connected.wait(5)
+        # congested, so the send loop sits in the delay with the QUIT already taken off the queue
+        irc.smoothed_lag = 0.2
+        irc.quit('bye')
+        gevent.sleep(0.05)
+        irc.stop(drain=True, timeout=5)
+        gevent.sleep(0.1)
+        assert [line for line in ircd.received if line.startswith(b'QUIT')] == [b'QUIT :bye']
+    finally:
+        irc.stop()
+        ircd.stop()
+
+def test_drain_timeout():
+    ircd = FakeIRCd(lines=1)
+    ircd.start()
+    irc = client.Client('127.0.0.1', 'bot', port=ircd.port, local_hostname='localhost')
+    irc.add_handler(lambda irc, msg: gevent.sleep(10), 'PRIVMSG')
+    try:
+        irc.start()
+        with gevent.Timeout(5):
+            while not irc._handler_group:
+                gevent.sleep(0.01)
+        with gevent.Timeout(2):
+            irc.stop(drain=True, timeout=0.1)
+        assert irc.stopped
+    finally:
+        ircd.stop()
+
+def test_concurrent_stops_tear_down_once():
+    ircd = FakeIRCd(lines=1)
+    ircd.start()
+    calls = []
+    irc = client.Client('127.0.0.1', 'bot', port=ircd.port, local_hostname='localhost',
+                        disconnect_handler=calls.append)
+    irc.add_handler(lambda irc, msg: gevent.sleep(0.2), 'PRIVMSG')
+    other = client.Client('127.0.0.1', 'other', port=ircd.port, local_hostname='localhost',
+                          disconnect_handler=calls.append)
+    try:
+        irc.start()
+        other.start()
+        with gevent.Timeout(5):
+            while not irc._handler_group or not other.connected.is_set():
+                gevent.sleep(0.01)
+        draining = gevent.spawn(irc.stop, drain=True, timeout=5)
+        gevent.sleep(0.01)
+        # waits for the drain to finish instead of cutting it short
+        irc.stop()
+        assert irc.stopped and not irc._handler_group
+        draining.join()
+        client.stop_all([other, other])
+        assert calls == [irc, other]
+    finally:
+        irc.stop()
+        other.stop()
+        ircd.stop()
+
+def test_stop_all_deadline():
+    ircd = FakeIRCd(lines=1)
+    ircd.start()
+    blocker = gevent.event.Event()
+    irc = client.Client('127.0.0.1', 'bot', port=ircd.port, local_hostname='localhost',
+                        disconnect_handler=lambda irc: blocker.wait())
+    try:
+        irc.start()
+        irc.connected.wait(5)
+        with gevent.Timeout(2):
+            client.stop_all([irc], timeout=0.1)
+        assert irc.stopped
+    finally:
+        blocker.set()
+        ircd.stop()
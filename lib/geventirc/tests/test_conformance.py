@@ -0,0 +1,80 @@
+"""Checks the compiled speedups (when built) against the pure-Python implementations.
+Any new parsing edge case should be added to CORPUS so the two can't diverge.
+"""
+
+import pytest
+
+from geventirc import message
+
+
+CORPUS = [
+    b'PING :irc.example.com',
+    b'PING irc.example.com',
+    b':irc.example.com 001 nick :Welcome to the network',
+    b':nick!user@host PRIVMSG #chan :hello world',
+    b':nick!user@host PRIVMSG #chan :',
+    b':nick!user@host PRIVMSG #chan ::starts with a colon',
+    b':nick!user@host JOIN #chan',
+    b':nick!user@host MODE #chan +ov a b',
+    b':server 353 nick = #chan :@op +voice user',
+    b'CMD  double  spaces :and a trailing',
+    b'CMD a b c',
+    b'CMD ',
+    b': CMD empty prefix',
+    b'PRIVMSG #chan :caf\xc3\xa9 caf\xe9',
+    b'PRIVMSG #chan :\x01ACTION waves\x01',
+    b'PRIVMSG #chan :\x01VERSION\x01',
+    b'PRIVMSG #chan :\x01PING \x01',
+    b'PRIVMSG #chan :before\x01ACTION x\x01middle\x01CLIENTINFO\x01after',
+    b'PRIVMSG #chan :\x01ACTION \x86a \x86\x86 \x86x\x01',
+    b'PRIVMSG #chan :\x01unterminated ctcp',
+    b'PRIVMSG #chan :low \x10r\x10n\x100\x10\x10\x10z level',
+    b'PRIVMSG #chan :quote at end \x10',
+    b'PRIVMSG #chan :ctcp quote at end \x01A \x86\x01',
+    b'PRIVMSG #chan :\x01\x01\x01\x01',
+]
+
+INVALID = [
+    b'',
+    b'NOCOMMAND',
+    b':prefix',
+    b':prefix NOPARAMS',
+    b':prefixonly CMD',
+]
+
+IMPLEMENTATIONS = [(message.py_irc_split, message.py_ctcp_split)]
+if message._speedups is not None:
+    IMPLEMENTATIONS.append((message._speedups.irc_split, message._speedups.ctcp_split))
+
+
+@pytest.mark.parametrize('irc_split, ctcp_split', IMPLEMENTATIONS)
+def test_corpus(irc_split, ctcp_split):
+    for line in CORPUS:
+        assert irc_split(line) == message.py_irc_split(line), line
+        assert ctcp_split(line) == message.py_ctcp_split(line), line
+        assert irc_split(memoryview(line)) == message.py_irc_split(line), line
+        assert irc_split(bytearray(line)) == message.py_irc_split(line), line
+        strided = memoryview(bytes(b for c in line for b in (c, 0)))[::2]
+        assert irc_split(strided) == message.py_irc_split(line), line
+        assert ctcp_split(strided) == message.py_ctcp_split(line), line
+
+@pytest.mark.parametrize('irc_split, ctcp_split', IMPLEMENTATIONS)
+def test_non_contiguous_buffer(irc_split, ctcp_split):
+    line = memoryview(b'P.I.N.G. .:.a')[::2]
+    assert irc_split(line) == (b'', b'PING', [b'a'])
+    assert ctcp_split(line) == (b'', b'PING', [b'a'], [])
+
+@pytest.mark.parametrize('irc_split, ctcp_split', IMPLEMENTATIONS)
+def test_invalid(irc_split, ctcp_split):
+    for line in INVALID:
+        for split in (irc_split, ctcp_split):
+            with pytest.raises(message.ProtocolViolationError):
+                split(line)
+
+def test_corpus_expectations():
+    assert message.py_irc_split(b'PING :irc.example.com') == (b'', b'PING', [b'irc.example.com'])
+    assert message.py_irc_split(b'CMD  double  spaces :and a trailing') == \
+        (b'', b'CMD', [b'', b'double', b'', b'spaces', b'and a trailing'])
+    assert message.py_ctcp_split(b'PRIVMSG #chan :before\x01ACTION x\x01middle\x01CLIENTINFO\x01after') == \
+        (b'', b'PRIVMSG', [b'#chan', b'before', b'middle', b'after'],
+         [(b'ACTION', b'x'), (b'CLIENTINFO', None)])
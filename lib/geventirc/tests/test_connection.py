@@ -0,0 +1,31 @@
+
+from gevent import socket
+
+from geventirc import connection
+
+
+def test_interleave():
+    v4 = [(socket.AF_INET, 0, 0, '', ('10.0.0.%d' % i, 1)) for i in range(3)]
+    v6 = [(socket.AF_INET6, 0, 0, '', ('::%d' % i, 1, 0, 0)) for i in range(2)]
+    assert connection.interleave(v6 + v4) == [v6[0], v4[0], v6[1], v4[1], v4[2]]
+
+def test_race_skips_dead_addresses():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    dead = socket.socket()
+    dead.bind(('127.0.0.1', 0)) # bound but not listening, so connections are refused
+    addrinfo = lambda sock: (socket.AF_INET, socket.SOCK_STREAM, 0, '', sock.getsockname())
+    try:
+        sock = connection.race([addrinfo(dead), addrinfo(listener)], attempt_delay=5)
+        assert sock.getpeername() == listener.getsockname()
+        sock.close()
+    finally:
+        listener.close()
+        dead.close()
+
+def test_dns_cache():
+    cache = connection.DNSCache()
+    addrinfos = cache.resolve('localhost', 6667)
+    assert addrinfos
+    assert cache.resolve('localhost', 6667) is addrinfos
@@ -0,0 +1,31 @@
+
+from geventirc import message
+
+
+def test_irc_split_bytes_and_memoryview():
+    line = b':nick!user@host PRIVMSG #chan :hello world'
+    expected = b'nick!user@host', b'PRIVMSG', [b'#chan', b'hello world']
+    assert message.irc_split(line) == expected
+    assert message.irc_split(memoryview(line)) == expected
+    assert message.irc_unsplit(*expected) == line
+
+def test_decode_is_lazy_and_falls_back_to_latin1():
+    msg = message.Message.decode(b':nick!user@host PRIVMSG #chan :caf\xe9')
+    assert msg.command == 'PRIVMSG'
+    assert msg._params is None
+    assert msg.params == ['#chan', u'caf\xe9']
+    assert msg.sender == 'nick'
+    msg = message.Message.decode(b'PRIVMSG #chan :caf\xc3\xa9')
+    assert msg.params[1] == u'caf\xe9'
+
+def test_encode_roundtrip():
+    line = b':nick!user@host PRIVMSG #chan :caf\xe9\r\n'
+    assert message.Message.decode(line[:-2]).encode() == line
+    assert message.PrivMsg('#chan', u'caf\xe9').encode() == b'PRIVMSG #chan :caf\xc3\xa9\r\n'
+
+def test_ctcp_dequoted_before_decoding():
+    # \x86 is the CTCP quote byte, and must not be confused with a decoded character
+    msg = message.CTCPMessage.decode(b'PRIVMSG #chan :\x01ACTION caf\xc3\xa9 \x86a\x01')
+    assert msg.params == ['#chan']
+    assert msg.ctcp_params == [('ACTION', u'caf\xe9 \x01')]
+    assert message.Me('#chan', 'waves').encode() == b'PRIVMSG #chan :\x01ACTION waves\x01\r\n'
@@ -0,0 +1,28 @@
+
+from geventirc import replay
+
+
+LINES = [
+    ':server 001 bot :Welcome',
+    'PING :server',
+    ':bob!b@host JOIN #chan',
+    ':bob!b@host PRIVMSG #chan :hello bot',
+]
+
+def test_replay_captures_sent_messages():
+    client = replay.ReplayAutoClient('bot', LINES, channels=['#chan'])
+    seen = []
+    client.add_handler(lambda client, msg: seen.append(' '.join(msg.params[1:])), 'PRIVMSG')
+    client.run()
+    assert seen == ['hello bot']
+    assert sorted(msg.command for msg in client.sent) == ['JOIN', 'NICK', 'PONG']
+    assert client.user_lists['#chan']['USER'] == ['bob']
+    assert client.lines == len(LINES)
+    assert all(stats.errors == 0 for stats in client.stats.values())
+
+def test_replay_realtime_paced_by_timestamps():
+    client = replay.ReplayClient('bot', [(0.0, 'PING :a'), (0.05, 'PING :b')], speed=1.0)
+    client.add_handler(lambda client, msg: client.send_message(msg), 'PING')
+    client.run()
+    assert [msg.params for msg in client.sent] == [['a'], ['b']]
+    assert client.elapsed >= 0.05
@@ -0,0 +1,106 @@
+
+import gc
+import weakref
+
+import gevent
+
+from geventirc import client, handlers
+from geventirc.scheduler import Scheduler, TaskGroup
+from geventirc.tests.fakeircd import FakeIRCd
+
+
+def test_call_later_and_cancel():
+    scheduler = Scheduler()
+    calls = []
+    scheduler.call_later(0.02, calls.append, 'b')
+    scheduler.call_later(0.01, calls.append, 'a')
+    scheduler.call_later(0.01, calls.append, 'cancelled').cancel()
+    gevent.sleep(0.05)
+    assert calls == ['a', 'b']
+    scheduler.stop()
+
+def test_call_every_skip_if_running():
+    scheduler = Scheduler()
+    task = scheduler.call_every(0.01, gevent.sleep, 0.035, skip_if_running=True)
+    gevent.sleep(0.1)
+    task.cancel()
+    assert task.runs >= 2
+    assert task.skipped >= 2
+    assert task.runs + task.skipped <= 11
+    scheduler.stop()
+
+def test_cancelled_tasks_are_released():
+    class Target(object):
+        def run(self):
+            pass
+    scheduler = Scheduler()
+    tasks = TaskGroup(scheduler)
+    targets = [Target() for i in range(100)]
+    refs = [weakref.ref(target) for target in targets]
+    for target in targets:
+        tasks.call_later(3600, target.run)
+    del targets, target
+    tasks.cancel()
+    gc.collect()
+    # without waiting an hour for them to come due
+    assert not any(ref() for ref in refs)
+    # clearing out cancelled tasks leaves the others alone
+    calls = []
+    scheduler.call_later(0.01, calls.append, 'kept')
+    for i in range(10):
+        scheduler.call_later(3600, calls.append, 'cancelled').cancel()
+    gevent.sleep(0.05)
+    assert calls == ['kept']
+    scheduler.stop()
+
+def test_periodic_message():
+    ircd = FakeIRCd(lines=0)
+    ircd.start()
+    irc = client.Client('127.0.0.1', 'bot', port=ircd.port, local_hostname='localhost')
+    periodic = handlers.PeriodicMessage('#chan', 'hi', wait=0.01)
+    irc.add_handler(periodic)
+    try:
+        irc.start()
+        with gevent.Timeout(5):
+            while ircd.received.count(b'PRIVMSG #chan :hi') < 3:
+                gevent.sleep(0.01)
+        task = periodic.tasks[irc]
+        assert task.runs >= 3
+    finally:
+        irc.stop()
+        ircd.stop()
+    assert task.cancelled
+    assert not periodic.tasks
+
+def test_client_tasks_cancelled_on_stop_with_shared_scheduler():
+    ircd = FakeIRCd(lines=0)
+    ircd.start()
+    scheduler = Scheduler()
+    periodic = handlers.PeriodicMessage('#chan', 'hi', wait=0.01)
+    clients = [client.Client('127.0.0.1', nick, port=ircd.port, local_hostname='localhost',
+                             scheduler=scheduler)
+               for nick in ('bot1', 'bot2')]
+    try:
+        for irc in clients:
+            irc.add_handler(periodic)
+            irc.start()
+        later = clients[0].scheduler.call_later(60, lambda: None)
+        with gevent.Timeout(5):
+            while len(periodic.tasks) < 2:
+                gevent.sleep(0.01)
+        first, second = periodic.tasks[clients[0]], periodic.tasks[clients[1]]
+        # adding the handler to the second client didn't affect the first
+        assert not first.cancelled
+        clients[0].stop()
+        assert first.cancelled and later.cancelled
+        # the shared scheduler, and the other client's task, carry on
+        runs = second.runs
+        gevent.sleep(0.05)
+        assert second.runs > runs
+        assert not scheduler.stopped
+    finally:
+        for irc in clients:
+            irc.stop()
+        ircd.stop()
+    assert second.cancelled
+    scheduler.stop()
@@ -0,0 +1,65 @@
+
+import os
+import signal
+
+import gevent
+
+from geventirc import message, shard
+from geventirc.tests.fakeircd import FakeIRCd
+
+
+def _wait_for(condition, timeout=20):
+    with gevent.Timeout(timeout):
+        while not condition():
+            gevent.sleep(0.05)
+
+def test_supervisor_shards_routes_and_restarts():
+    ircd = FakeIRCd(lines=100)
+    ircd.start()
+    supervisor = shard.Supervisor(workers=2, restart_delay=0)
+    supervisor.start()
+    try:
+        for i in range(4):
+            supervisor.add_bot('bot%d' % i, 'geventirc.client:Client', '127.0.0.1', 'bot%d' % i,
+                               port=ircd.port, local_hostname='localhost')
+        _wait_for(lambda: sum(m['lines'] for m in supervisor.metrics()) == 4 * 101)
+        assert [m['bots'] for m in supervisor.metrics()] == [2, 2]
+
+        supervisor.send_message('bot0', message.PrivMsg('#chan', 'hello'))
+        _wait_for(lambda: b'PRIVMSG #chan :hello' in ircd.received)
+
+        # the bots of a dead worker are restored when it is restarted, the other worker is untouched
+        worker, spec = supervisor.bots['bot0']
+        other = [w for w in supervisor.workers if w is not worker][0]
+        old_pid, other_pid = worker.process.pid, other.process.pid
+        os.kill(old_pid, signal.SIGKILL)
+        _wait_for(lambda: worker.process.pid != old_pid)
+        _wait_for(lambda: (supervisor.metrics()[worker.index] or {}).get('running') == 2)
+        assert other.process.pid == other_pid
+        assert supervisor.metrics()[other.index]['lines'] == 2 * 101
+
+        supervisor.stop(drain=True, timeout=5)
+        _wait_for(lambda: len([line for line in ircd.received if line.startswith(b'QUIT')]) == 4)
+    finally:
+        supervisor.stop()
+        ircd.stop()
+
+def test_add_bot_while_worker_restarts():
+    ircd = FakeIRCd(lines=0)
+    ircd.start()
+    supervisor = shard.Supervisor(workers=1, restart_delay=0.5)
+    supervisor.start()
+    try:
+        supervisor.add_bot('bot0', 'geventirc.client:Client', '127.0.0.1', 'bot0',
+                           port=ircd.port, local_hostname='localhost')
+        worker = supervisor.workers[0]
+        os.kill(worker.process.pid, signal.SIGKILL)
+        _wait_for(lambda: not supervisor._ready[0].is_set())
+        # waits for the restart, and is added once, not also restored along with bot0
+        supervisor.add_bot('bot1', 'geventirc.client:Client', '127.0.0.1', 'bot1',
+                           port=ircd.port, local_hostname='localhost')
+        assert sorted(supervisor.bots) == ['bot0', 'bot1']
+        _wait_for(lambda: (supervisor.metrics()[0] or {}).get('running') == 2)
+    finally:
+        supervisor.stop()
+        ircd.stop()
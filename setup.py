@@ -1,4 +1,4 @@
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 
 setup(name="geventirc",
       version="0.1dev",
@@ -7,9 +7,13 @@ setup(name="geventirc",
       description="gevent based irc client",
       package_dir = {'':'lib'},
       packages=find_packages('lib'),
+      # optional: if it fails to build, geventirc.message falls back to pure Python
+      ext_modules=[
+          Extension('geventirc._speedups', ['lib/geventirc/_speedups.c'], optional=True),
+        ],
       zip_safe=False,
+      python_requires='>=3',
       install_requires=[
-          'distribute',
           'gevent',
         ],
     )